@@ -81,7 +81,7 @@ if __name__ == "__main__":
     
     # monitor job status
     if opts.monitorStatus:
-        toolbox.monitorJobStatus(jobIDs)
+        toolbox.monitorJobStatus(jobIDs, workdir = workdir)
 
     print("done.")
 
@@ -3,6 +3,7 @@ import os
 import subprocess
 import re
 import optparse
+import glob
 import time
 
 import toolbox
@@ -24,11 +25,11 @@ toolbox.printInfo("checking jobs:")
 for p in projects: toolbox.printPath("\t"+p) 
 toolbox.printDelim("=",30)
 
-results = []
-for project in projects:
-    toolbox.printAction("querying job {}".format(project))
-    
-    result = toolbox.crab_query(project, opts)
-    results.append(result)
+if opts.watch:
+    toolbox.crab_watch(projects, opts)
+    sys.exit()
+
+results = toolbox.crab_query_all(projects, opts)
 
 toolbox.print_crab_summary(results)
+toolbox.save_crab_summary(results, opts)
@@ -0,0 +1,151 @@
+import os
+import time
+
+import toolbox.batchBackend as batchBackend
+import toolbox.condorLog as condorLog
+
+bulkSubmitFile = """universe = vanilla
+executable = /bin/zsh
+arguments = a_arraySubmit.sh
+JobBatchName = a
+
+Queue Environment From (
+"SGE_TASK_ID=1"
+"SGE_TASK_ID=2"
+)
+
+arguments = b_arraySubmit.sh $(Step)
+JobBatchName = b
+
+Queue 3
+"""
+
+class FakeCondorCli(batchBackend.CondorCliBackend):
+    ''' condor command line backend returning canned outputs instead of calling condor '''
+    def __init__(self, outputs, **kwargs):
+        batchBackend.CondorCliBackend.__init__(self, **kwargs)
+        self.outputs = list(outputs)
+        self.commands = []
+
+    def _call(self, command):
+        self.commands.append(command)
+        return self.outputs.pop(0)
+
+def test_split_submit_file():
+    descriptions = batchBackend._splitSubmitFile(bulkSubmitFile)
+    assert len(descriptions) == 2
+    assert "a_arraySubmit.sh" in descriptions[0]
+    assert "\"SGE_TASK_ID=2\"\n)" in descriptions[0]
+    assert not "Queue 3" in descriptions[0]
+    # assignments before the first queue statement hold for the second as well
+    assert "executable = /bin/zsh" in descriptions[1]
+    assert descriptions[1].rstrip().endswith("Queue 3")
+    assert descriptions[1].count("Queue") == 1
+
+class FakeSubmitResult:
+    def __init__(self, cluster, nProcs):
+        self.clusterID = cluster
+        self.nProcs = nProcs
+
+    def cluster(self):
+        return self.clusterID
+
+    def first_proc(self):
+        return 0
+
+    def num_procs(self):
+        return self.nProcs
+
+class FakeSchedd:
+    def __init__(self):
+        self.descriptions = []
+
+    def submit(self, description, count = 0):
+        self.descriptions.append(description)
+        nProcs = 2 if "SGE_TASK_ID" in description else 3
+        return FakeSubmitResult(100+len(self.descriptions), nProcs)
+
+class FakeHTCondor:
+    @staticmethod
+    def Submit(code):
+        return code
+
+def test_htcondor_submits_every_queue_statement(tmpdir, monkeypatch):
+    monkeypatch.setattr(batchBackend, "htcondor", FakeHTCondor)
+    path = os.path.join(str(tmpdir), "bulk.sub")
+    with open(path, "w") as f:
+        f.write(bulkSubmitFile)
+    schedd = FakeSchedd()
+    backend = batchBackend.HTCondorBackend(schedd = schedd)
+    assert backend.submit(path) == [(101, 0, 1), (102, 0, 2)]
+    assert len(schedd.descriptions) == 2
+
+def test_cli_submit_parses_terse_output():
+    backend = FakeCondorCli([(0, "1234.0 - 1234.1\n1234.2 - 1234.4\n")])
+    assert backend.submit("bulk.sub") == [(1234, 0, 1), (1234, 2, 4)]
+    assert backend.commands[0] == ["condor_submit", "-terse", "bulk.sub"]
+
+def test_cli_submit_retries(monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    backend = FakeCondorCli([(1, "ERROR: schedd not reachable\n"), (0, "77.0 - 77.0\n")], maxTries = 2)
+    assert backend.submit("job.sub") == [(77, 0, 0)]
+    assert len(backend.commands) == 2
+
+def test_cli_job_status_and_query():
+    output = "1234 0 1\n1234 1 2\n1234 2 5\n1235 0 7\n1235 1 4\n-- garbage line\n"
+    backend = FakeCondorCli([(0, output), (0, output)])
+    assert backend.jobStatus(["1234", "1235"]) == {
+        (1234, 0): "idle", (1234, 1): "running", (1234, 2): "held", (1235, 0): "idle"}
+    counts = backend.query(["1234.1", "1236"])
+    assert counts[1234] == {"idle": 1, "running": 1, "held": 1}
+    # queried clusters without jobs in the queue are reported empty
+    assert counts[1236] == {"idle": 0, "running": 0, "held": 0}
+    assert backend.commands[1][:3] == ["condor_q", "1234.1", "1236"]
+
+def test_cli_query_failure():
+    backend = FakeCondorCli([(1, "-- Failed to fetch ads\n")])
+    assert backend.query(["1234"]) is None
+
+def _runLocal(tmpdir, executable, arguments, nJobs = 1):
+    logdir = str(tmpdir)
+    path = os.path.join(logdir, "job.sub")
+    with open(path, "w") as f:
+        f.write("""executable = {executable}
+arguments = {arguments}
+log    = {dir}/job.$(Cluster)_$(ProcId).log
+output = {dir}/job.$(Cluster)_$(ProcId).out
+error  = {dir}/job.$(Cluster)_$(ProcId).err
+RequestMemory = 1000
+Queue {n}
+""".format(executable = executable, arguments = arguments, dir = logdir, n = nJobs))
+    backend = batchBackend.LocalBackend(ncores = 2)
+    clusters = backend.submit(path)
+    cluster = clusters[0][0]
+    # wait for all jobs, including their terminate events
+    backend.pool.close()
+    backend.pool.join()
+    assert backend.jobStatus([cluster]) == {}
+    events = []
+    for proc in range(nJobs):
+        with open(os.path.join(logdir, "job.{}_{}.log".format(cluster, proc)), "r") as f:
+            events.append(condorLog.parseEvents(f.read())[0])
+    return clusters, events
+
+def test_local_backend_log_events(tmpdir):
+    clusters, events = _runLocal(tmpdir, "/bin/sh", "-c 'exit $(Step)'", nJobs = 2)
+    assert clusters == [(clusters[0][0], 0, 1)]
+    for proc, jobEvents in enumerate(events):
+        assert [e["code"] for e in jobEvents] == ["000", "001", "005"]
+        assert all(e["cluster"] == clusters[0][0] and e["proc"] == proc for e in jobEvents)
+
+    tracker = condorLog.JobTracker()
+    tracker.update(events[0] + events[1])
+    assert tracker.jobs[(clusters[0][0], 0)]["status"] == "done"
+    assert tracker.jobs[(clusters[0][0], 1)]["status"] == "failed"
+    assert tracker.jobs[(clusters[0][0], 1)]["exitCode"] == 1
+    assert tracker.jobs[(clusters[0][0], 0)]["memoryRequest"] == 1000
+
+def test_local_backend_missing_executable(tmpdir):
+    _, events = _runLocal(tmpdir, "/nonexistent/shell", "script.sh")
+    assert [e["code"] for e in events[0]] == ["000", "001", "005"]
+    assert "(return value 1)" in events[0][-1]["lines"][0]
@@ -0,0 +1,68 @@
+import json
+import optparse
+
+import toolbox.mrcrab as mrcrab
+
+statusTemplate = """CRAB project directory:\t\t{path}
+Task name:\t\t\t200101_120000:user_crab_test
+Status on the CRAB server:\tSUBMITTED
+Task URL to use for HELP:\thttps://cmsweb.cern.ch/crabserver/ui/task/x
+Status on the scheduler:\t{scheduler}
+
+Jobs status:                    finished     \t\t {finished}.0% ( {finished}/100)
+{failed}
+Error Summary: (use crab status --verboseErrors for details about the errors)
+
+  {nfailed} jobs failed with exit code 50660
+
+Log file is /tmp/crab.log
+"""
+
+def fake_crab(monkeypatch, scheduler = "FAILED", finished = 90, hang = False):
+    ''' replace the crab calls by canned status outputs, returns the list of resubmit commands '''
+    resubmits = []
+    def run_crab(self, command, timeout = None):
+        if command[1] == "resubmit":
+            resubmits.append(command)
+            return "Resubmit request sent"
+        if hang:
+            return None
+        failed = ""
+        if finished < 100:
+            failed = "\t\t\t\tfailed       \t\t {0}.0% ( {0}/100)\n".format(100-finished)
+        return statusTemplate.format(path = self.path, scheduler = scheduler,
+            finished = finished, failed = failed, nfailed = 100-finished)
+    monkeypatch.setattr(mrcrab.CrabResult, "run_crab", run_crab)
+    return resubmits
+
+def watch_options(tmpdir, maxRetries = 1):
+    policy = tmpdir.join("policy.json")
+    policy.write(json.dumps({"maxRetries": maxRetries}))
+    parser = mrcrab.setup_crab_query_parser(optparse.OptionParser())
+    opts, _ = parser.parse_args(["--no-cache", "--watch", "0", "--policy", str(policy),
+        "--history", "", "--db", "", "--jobs", "2"])
+    return opts
+
+def test_watch_gives_up_on_failed_task(tmpdir, monkeypatch):
+    # a finished task with failed jobs shows up as SUBMITTED with scheduler status FAILED
+    resubmits = fake_crab(monkeypatch, scheduler = "FAILED")
+    project = tmpdir.mkdir("crab_failed")
+    results = mrcrab.crab_watch([str(project)], watch_options(tmpdir, maxRetries = 1))
+    assert len(resubmits) == 1
+    assert results[0].given_up
+
+def test_watch_gives_up_on_unreachable_task(tmpdir, monkeypatch):
+    resubmits = fake_crab(monkeypatch, hang = True)
+    project = tmpdir.mkdir("crab_hang")
+    results = mrcrab.crab_watch([str(project)], watch_options(tmpdir), maxFailedChecks = 2)
+    assert len(resubmits) == 0
+    assert results[0].status == "TIMEOUT"
+    assert results[0].given_up
+
+def test_watch_ends_on_completed_task(tmpdir, monkeypatch):
+    resubmits = fake_crab(monkeypatch, scheduler = "COMPLETED", finished = 100)
+    project = tmpdir.mkdir("crab_done")
+    results = mrcrab.crab_watch([str(project)], watch_options(tmpdir))
+    assert len(resubmits) == 0
+    assert results[0].is_final()
+    assert not results[0].given_up
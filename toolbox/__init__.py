@@ -9,13 +9,18 @@ try:
     from condorSubmit import submitToBatch
     from condorSubmit import monitorJobStatus
     from condorSubmit import writeSubmitScript
+    from batchBackend import setBackend
 
     from mrcrab import crab_query
+    from mrcrab import crab_query_all
+    from mrcrab import crab_watch
     from mrcrab import crab_report
     from mrcrab import print_crab_summary
+    from mrcrab import save_crab_summary
     from mrcrab import setup_crab_query_parser
 
     import rutil
+    from mergePlan import MergePlan
     import plotSetup
 
     from yieldTable import yieldTable
@@ -36,13 +41,18 @@ except:
     from .condorSubmit import submitToBatch
     from .condorSubmit import monitorJobStatus
     from .condorSubmit import writeSubmitScript
+    from .batchBackend import setBackend
 
     from .mrcrab import crab_query
+    from .mrcrab import crab_query_all
+    from .mrcrab import crab_watch
     from .mrcrab import crab_report
     from .mrcrab import print_crab_summary
+    from .mrcrab import save_crab_summary
     from .mrcrab import setup_crab_query_parser
 
     from . import rutil
+    from .mergePlan import MergePlan
     from . import plotSetup
 
     from .yieldTable import yieldTable
@@ -0,0 +1,404 @@
+import os
+import re
+import sys
+import time
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import toolbox.printer as printer
+
+try:
+    import htcondor
+except ImportError:
+    htcondor = None
+
+# scheduler backends used by condorSubmit to submit, query and remove jobs
+#
+# every backend implements
+#     submit(submitPath): list of (cluster, first ProcId, last ProcId)
+#     jobStatus(jobIDs):  dictionary (cluster, proc) -> "idle", "running" or "held" of the
+#                         jobs still in the queue, None if the query failed
+#     query(jobIDs):      dictionary cluster -> {"idle", "running", "held"} of jobs
+#                         still in the queue, None if the query failed
+#     remove(jobIDs):     remove the jobs
+# job IDs are given as 'cluster' or 'cluster.proc'
+
+# condor JobStatus codes
+jobStatusNames = {1: "idle", 2: "running", 5: "held", 7: "idle"}
+
+def _emptyCounts():
+    return {"idle": 0, "running": 0, "held": 0}
+
+def _splitJobID(jobID):
+    ''' (cluster, proc) of a job ID 'cluster' or 'cluster.proc', proc is None for whole clusters '''
+    parts = str(jobID).split(".")
+    if len(parts) == 1:
+        return int(parts[0]), None
+    return int(parts[0]), int(parts[1])
+
+def _countJobs(jobIDs, statuses):
+    ''' counts per cluster of the job statuses returned by jobStatus '''
+    if statuses is None:
+        return None
+    counts = dict((_splitJobID(j)[0], _emptyCounts()) for j in (jobIDs or []))
+    for (cluster, proc), status in statuses.items():
+        counts.setdefault(cluster, _emptyCounts())[status] += 1
+    return counts
+
+def _splitSubmitFile(text):
+    '''
+        one submit description per queue statement of text (e.g. the bulk file of
+        submitGroupsToBatch), each with all assignments made before its queue statement
+    '''
+    settings = []
+    descriptions = []
+    lines = iter(text.split("\n"))
+    for line in lines:
+        if not line.strip().lower().startswith("queue"):
+            settings.append(line)
+            continue
+        queue = [line]
+        # items of 'queue ... from (' up to the closing bracket
+        if line.rstrip().endswith("("):
+            for item in lines:
+                queue.append(item)
+                if item.strip() == ")":
+                    break
+        descriptions.append("\n".join(settings + queue)+"\n")
+    return descriptions
+
+def _matches(jobIDs, cluster, proc):
+    for jobID in jobIDs:
+        c, p = _splitJobID(jobID)
+        if c == cluster and (p is None or p == proc):
+            return True
+    return False
+
+class CondorCliBackend:
+    '''
+        backend calling the condor command line tools
+
+        failing submissions are retried up to maxTries times with exponentially
+        growing delays starting at backoff seconds up to maxDelay seconds
+    '''
+    name = "condor"
+    terseRegex = re.compile(r"^\s*(\d+)\.(\d+)\s*-\s*(\d+)\.(\d+)\s*$")
+
+    def __init__(self, maxTries = 10, backoff = 10, maxDelay = 600):
+        self.maxTries = maxTries
+        self.backoff = backoff
+        self.maxDelay = maxDelay
+
+    def _call(self, command):
+        process = subprocess.Popen(command, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, stdin = subprocess.PIPE,
+            universal_newlines = True)
+        output = process.communicate()[0]
+        return process.returncode, output
+
+    def submit(self, submitPath):
+        submitCommand = ["condor_submit", "-terse", submitPath]
+        printer.printCommand("submitting {}".format(" ".join(submitCommand)))
+        for tries in range(self.maxTries+1):
+            returncode, output = self._call(submitCommand)
+            clusters = []
+            for line in output.split("\n"):
+                match = self.terseRegex.match(line)
+                if not match is None:
+                    clusters.append((int(match.group(1)), int(match.group(2)), int(match.group(4))))
+            if returncode == 0 and len(clusters) > 0:
+                return clusters
+
+            print("something went wrong with calling the condor_submit command, submission of jobs was not successful")
+            print("DEBUG:")
+            print(output)
+            if tries < self.maxTries:
+                delay = min(self.backoff*2**tries, self.maxDelay)
+                printer.printWarning("retrying in {} seconds".format(delay))
+                time.sleep(delay)
+        print("job submission was not successful after {} tries - exiting without JOBID".format(self.maxTries+1))
+        sys.exit(-1)
+
+    def jobStatus(self, jobIDs = None):
+        command = ["condor_q"] + [str(j) for j in (jobIDs or [])] + ["-af", "ClusterId", "ProcId", "JobStatus"]
+        returncode, output = self._call(command)
+        if not returncode == 0:
+            return None
+        statuses = {}
+        for line in output.split("\n"):
+            fields = line.split()
+            if not len(fields) == 3 or not all(f.isdigit() for f in fields):
+                continue
+            status = jobStatusNames.get(int(fields[2]))
+            if not status is None:
+                statuses[(int(fields[0]), int(fields[1]))] = status
+        return statuses
+
+    def query(self, jobIDs = None):
+        return _countJobs(jobIDs, self.jobStatus(jobIDs))
+
+    def remove(self, jobIDs):
+        command = ["condor_rm"] + [str(j) for j in jobIDs]
+        printer.printCommand(" ".join(command))
+        self._call(command)
+
+class HTCondorBackend:
+    '''
+        backend using the htcondor python bindings, talking to the schedd directly
+    '''
+    name = "htcondor"
+
+    def __init__(self, schedd = None):
+        if htcondor is None:
+            raise ImportError("the htcondor python bindings are not available")
+        self.schedd = schedd or htcondor.Schedd()
+
+    def submit(self, submitPath):
+        with open(submitPath, "r") as f:
+            text = f.read()
+        printer.printCommand("submitting {} via htcondor bindings".format(submitPath))
+        # a Submit object holds a single queue statement, every one is submitted on its own
+        clusters = []
+        for code in _splitSubmitFile(text):
+            # count 0 uses the queue statement of the description
+            result = self.schedd.submit(htcondor.Submit(code), count = 0)
+            first = result.first_proc()
+            clusters.append((result.cluster(), first, first + result.num_procs() - 1))
+        return clusters
+
+    def _constraint(self, jobIDs):
+        if not jobIDs:
+            return "Owner == \"{}\"".format(os.environ.get("USER", ""))
+        constraints = []
+        for jobID in jobIDs:
+            cluster, proc = _splitJobID(jobID)
+            if proc is None:
+                constraints.append("ClusterId == {}".format(cluster))
+            else:
+                constraints.append("(ClusterId == {} && ProcId == {})".format(cluster, proc))
+        return " || ".join(constraints)
+
+    def jobStatus(self, jobIDs = None):
+        try:
+            ads = self.schedd.query(constraint = self._constraint(jobIDs),
+                projection = ["ClusterId", "ProcId", "JobStatus"])
+        except Exception as e:
+            printer.printWarning("schedd query failed: {}".format(e))
+            return None
+        statuses = {}
+        for ad in ads:
+            status = jobStatusNames.get(int(ad["JobStatus"]))
+            if not status is None:
+                statuses[(int(ad["ClusterId"]), int(ad["ProcId"]))] = status
+        return statuses
+
+    def query(self, jobIDs = None):
+        return _countJobs(jobIDs, self.jobStatus(jobIDs))
+
+    def remove(self, jobIDs):
+        self.schedd.act(htcondor.JobAction.Remove, self._constraint(jobIDs))
+
+class LocalBackend:
+    '''
+        backend running the jobs of a submit file on the current machine
+
+        the submit file is read like condor_submit does (assignments followed by
+        queue statements) and every queued job runs the executable with its
+        arguments and environment (i.e. the same SGE_TASK_ID contract as on the batch
+        system) on a pool of ncores processes. jobs with transfer_input_files run
+        in a scratch directory with copies of their inputs. output, error and the user log
+        with submit/execute/terminate events are written to the paths of the
+        submit file, such that condorSubmit.monitorJobLogs can follow the jobs.
+
+        executable optionally overrides the executable of the submit file
+    '''
+    name = "local"
+    queueRegex = re.compile(r"^queue\s*(.*?)\s*from\s*\(\s*$", re.IGNORECASE)
+    macroRegex = re.compile(r"\$\((\w+)\)")
+
+    def __init__(self, ncores = None, executable = None):
+        self.ncores = ncores or multiprocessing.cpu_count()
+        self.executable = executable
+        self.pool = ThreadPool(self.ncores)
+        self.lock = threading.Lock()
+        self.nextCluster = int(time.time()) % 1000000
+        self.jobs = {}
+        self.processes = {}
+
+    def _expand(self, value, macros):
+        return self.macroRegex.sub(lambda m: str(macros.get(m.group(1).lower(), m.group(0))), value)
+
+    def _readSubmitFile(self, submitPath):
+        ''' list of job descriptions (dictionaries of lower case keys) queued in the submit file '''
+        settings = {}
+        jobs = []
+        with open(submitPath, "r") as f:
+            lines = iter(f.read().split("\n"))
+        for line in lines:
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            match = self.queueRegex.match(line)
+            if not match is None:
+                variables = [v.strip().lower() for v in match.group(1).split(",")]
+                step = 0
+                for item in lines:
+                    if item.strip() == ")":
+                        break
+                    values = item.split(None, len(variables)-1)
+                    job = dict(settings, step = step)
+                    job.update(dict(zip(variables, values)))
+                    jobs.append(job)
+                    step += 1
+                continue
+            if line.lower().startswith("queue"):
+                count = line[5:].strip()
+                for step in range(int(count) if count.isdigit() else 1):
+                    jobs.append(dict(settings, step = step))
+                continue
+            if "=" in line:
+                key, value = line.split("=", 1)
+                settings[key.strip().lstrip("+").lower()] = value.strip()
+        return jobs
+
+    def _writeEvent(self, job, code, text, lines = []):
+        if not job.get("log"):
+            return
+        header = "{} ({:03d}.{:03d}.000) {} {}\n".format(code, job["cluster"], job["proc"],
+            time.strftime("%Y-%m-%d %H:%M:%S"), text)
+        with self.lock:
+            with open(job["log"], "a") as log:
+                log.write(header + "".join("\t"+l+"\n" for l in lines) + "...\n")
+
+    def submit(self, submitPath):
+        descriptions = self._readSubmitFile(submitPath)
+        with self.lock:
+            cluster = self.nextCluster
+            self.nextCluster += 1
+        printer.printCommand("running {} jobs of {} locally as cluster {}".format(
+            len(descriptions), submitPath, cluster))
+        for proc, description in enumerate(descriptions):
+            macros = dict(description)
+            macros.update({"cluster": cluster, "procid": proc, "process": proc})
+            environment = dict(os.environ)
+            env = self._expand(description.get("environment", ""), macros).strip("\"")
+            for assignment in shlex.split(env):
+                if "=" in assignment:
+                    key, value = assignment.split("=", 1)
+                    environment[key] = value
+            job = {
+                "cluster":      cluster,
+                "proc":         proc,
+                "command":      [self.executable or description["executable"]] +
+                                    shlex.split(self._expand(description.get("arguments", ""), macros)),
+                "environment":  environment,
+                "log":          self._expand(description.get("log", ""), macros),
+                "output":       self._expand(description.get("output", ""), macros),
+                "error":        self._expand(description.get("error", ""), macros),
+                "memory":       self._expand(description.get("requestmemory", "0"), macros),
+                "inputs":       [i.strip() for i in self._expand(description.get("transfer_input_files", ""), macros).split(",") if i.strip()],
+                "status":       "idle",
+                }
+            self.jobs[(cluster, proc)] = job
+            self._writeEvent(job, "000", "Job submitted from host: <{}>".format(socket.gethostname()))
+            self.pool.apply_async(self._run, (job,))
+        return [(cluster, 0, len(descriptions)-1)]
+
+    def _run(self, job):
+        if not job["status"] == "idle":
+            return
+        job["status"] = "running"
+        self._writeEvent(job, "001", "Job executing on host: <{}>".format(socket.gethostname()))
+        out = err = scratch = None
+        # a job that cannot be started terminates with return value 1
+        status = 1 << 8
+        memory = 0
+        try:
+            out = open(job["output"] or os.devnull, "w")
+            err = open(job["error"] or os.devnull, "w")
+            if job["inputs"]:
+                scratch = tempfile.mkdtemp(prefix = "condor_{}_{}_".format(job["cluster"], job["proc"]))
+                for f in job["inputs"]:
+                    shutil.copy(f, scratch)
+            process = subprocess.Popen(job["command"], stdout = out, stderr = err,
+                env = job["environment"], cwd = scratch)
+            self.processes[(job["cluster"], job["proc"])] = process
+            # wait4 reports the peak memory usage of the job
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = status
+            memory = int(usage.ru_maxrss/1024)
+        except Exception as e:
+            printer.printError("could not run job {}.{}: {}".format(job["cluster"], job["proc"], e))
+            if not err is None:
+                err.write("could not run {}: {}\n".format(" ".join(job["command"]), e))
+        finally:
+            for f in [out, err]:
+                if not f is None:
+                    f.close()
+            if not scratch is None:
+                shutil.rmtree(scratch, ignore_errors = True)
+
+        if os.WIFSIGNALED(status):
+            result = "(0) Abnormal termination (signal {})".format(os.WTERMSIG(status))
+        else:
+            result = "(1) Normal termination (return value {})".format(os.WEXITSTATUS(status))
+        if job["status"] == "removed":
+            return
+        job["status"] = "done"
+        self._writeEvent(job, "005", "Job terminated.", [result,
+            "Partitionable Resources :    Usage  Request Allocated",
+            "   Memory (MB)          : {:>8} {:>9} {:>9}".format(memory, job["memory"], job["memory"])])
+
+    def jobStatus(self, jobIDs = None):
+        statuses = {}
+        for (cluster, proc), job in list(self.jobs.items()):
+            if jobIDs and not _matches(jobIDs, cluster, proc):
+                continue
+            if job["status"] in ["idle", "running"]:
+                statuses[(cluster, proc)] = job["status"]
+        return statuses
+
+    def query(self, jobIDs = None):
+        return _countJobs(jobIDs, self.jobStatus(jobIDs))
+
+    def remove(self, jobIDs):
+        for (cluster, proc), job in list(self.jobs.items()):
+            if not _matches(jobIDs, cluster, proc) or not job["status"] in ["idle", "running"]:
+                continue
+            running = job["status"] == "running"
+            job["status"] = "removed"
+            process = self.processes.get((cluster, proc))
+            if running and not process is None:
+                try:
+                    process.send_signal(signal.SIGTERM)
+                except OSError:
+                    pass
+            self._writeEvent(job, "009", "Job was aborted.", ["via LocalBackend.remove"])
+
+backends = {
+    "condor":   CondorCliBackend,
+    "htcondor": HTCondorBackend,
+    "local":    LocalBackend,
+    }
+
+_backend = None
+def getBackend():
+    ''' backend used by condorSubmit, by default the condor command line tools '''
+    global _backend
+    if _backend is None:
+        _backend = CondorCliBackend()
+    return _backend
+
+def setBackend(backend, **kwargs):
+    ''' set the backend used by condorSubmit, either a backend object or its name in backends '''
+    global _backend
+    if isinstance(backend, str):
+        backend = backends[backend](**kwargs)
+    _backend = backend
+    return _backend
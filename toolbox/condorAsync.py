@@ -0,0 +1,146 @@
+import time
+import asyncio
+
+import toolbox.printer as printer
+import toolbox.batchBackend as batchBackend
+from toolbox.condorSubmit import printJobCounts
+
+# asynchronous monitoring of many condor clusters
+#
+# this module uses asyncio and therefore needs python 3,
+# it is not imported by the toolbox package itself:
+#     from toolbox.condorAsync import ClusterMonitor
+
+class ClusterMonitor:
+    '''
+        monitor the jobs of many submissions in a single event loop
+
+        every queryInterval seconds one query of the scheduler backend is made for
+        the jobs in the clusters of all watched submissions (in an executor thread, so the
+        event loop is not blocked). as soon as no job of a submission is left in
+        the queue its callback is started, e.g. the hadd of a sample. plain
+        functions run in an executor thread, coroutine functions as tasks on the
+        loop. callbacks are called with the name and the job IDs of the submission
+        and may watch further submissions.
+
+        usage:
+            monitor = ClusterMonitor(queryInterval = 60)
+            for sample in samples:
+                jobIDs = submitToBatch(...)
+                monitor.watch(jobIDs, name = sample,
+                    callback = lambda name, jobIDs: rutil.hadd(files[name], targets[name]))
+            results = monitor.runUntilComplete()
+    '''
+    def __init__(self, queryInterval = 60, backend = None, maxErrors = 60):
+        self.queryInterval = queryInterval
+        self.backend = backend
+        self.maxErrors = maxErrors
+
+        self.groups = []
+        self.tasks = []
+        self.results = {}
+
+    def watch(self, jobIDs, callback = None, name = None):
+        '''
+            watch the jobs, given as cluster IDs (as returned by submitToBatch) or
+            'cluster.proc' IDs (as returned by submitGroupsToBatch).
+            returns the name of the submission
+        '''
+        if name is None:
+            name = ",".join(str(j) for j in jobIDs)
+        jobs = [batchBackend._splitJobID(j) for j in jobIDs]
+        self.groups.append({
+            "name":         name,
+            "jobIDs":       list(jobIDs),
+            "clusters":     set(c for c, p in jobs),
+            # watched whole clusters and single 'cluster.proc' jobs
+            "watched":      set(c for c, p in jobs if p is None),
+            "procs":        set((c, p) for c, p in jobs if not p is None),
+            "callback":     callback,
+            "done":         False,
+            "submitTime":   time.time(),
+            })
+        return name
+
+    def pending(self):
+        return [group for group in self.groups if not group["done"]]
+
+    def _finish(self, group):
+        group["done"] = True
+        printer.printInfo("all jobs of {} are finished after {:.0f} s".format(
+            group["name"], time.time() - group["submitTime"]))
+        callback = group["callback"]
+        if callback is None:
+            return
+        if asyncio.iscoroutinefunction(callback):
+            task = asyncio.ensure_future(callback(group["name"], group["jobIDs"]))
+        else:
+            task = asyncio.get_event_loop().run_in_executor(None, callback, group["name"], group["jobIDs"])
+        self.tasks.append((group["name"], task))
+
+    def _update(self, statuses):
+        ''' finish all submissions without jobs left in statuses, return the summed counts of the others '''
+        total = batchBackend._emptyCounts()
+        for group in self.pending():
+            queued = batchBackend._emptyCounts()
+            for (cluster, proc), status in statuses.items():
+                if cluster in group["watched"] or (cluster, proc) in group["procs"]:
+                    queued[status] += 1
+            if sum(queued.values()) == 0:
+                self._finish(group)
+                continue
+            for status in total:
+                total[status] += queued[status]
+        return total
+
+    async def run(self):
+        '''
+            monitor until all watched submissions are finished and their callbacks returned.
+            returns a dictionary name -> return value of the callback (the exception if it failed)
+        '''
+        loop = asyncio.get_event_loop()
+        backend = self.backend or batchBackend.getBackend()
+        printer.printAction("checking job status of {} submissions in {} queue ...".format(
+            len(self.pending()), backend.name), 1)
+        errorcount = 0
+        while self.pending() or any(not task.done() for _, task in self.tasks):
+            if not self.pending():
+                # only callbacks left, they may still watch further submissions
+                await asyncio.wait([task for _, task in self.tasks if not task.done()],
+                    return_when = asyncio.FIRST_COMPLETED)
+                continue
+
+            await asyncio.sleep(self.queryInterval)
+            clusters = sorted(set(c for group in self.pending() for c in group["clusters"]))
+            statuses = await loop.run_in_executor(None, backend.jobStatus, clusters)
+            if statuses is None:
+                errorcount += 1
+                printer.printWarning("job query failed")
+                if errorcount == self.maxErrors:
+                    printer.printError("job query failed {} times - giving up on {} submissions".format(
+                        errorcount, len(self.pending())))
+                    for group in self.pending():
+                        group["done"] = True
+                continue
+
+            errorcount = 0
+            total = self._update(statuses)
+            printJobCounts(total, None)
+            printer.printInfo("{}/{} submissions finished".format(
+                len(self.groups) - len(self.pending()), len(self.groups)))
+
+        for name, task in self.tasks:
+            try:
+                self.results[name] = task.result()
+            except Exception as e:
+                printer.printError("callback of {} failed: {}".format(name, e))
+                self.results[name] = e
+        return self.results
+
+    def runUntilComplete(self):
+        ''' run the monitor on the event loop from synchronous code '''
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.run())
+        finally:
+            loop.close()
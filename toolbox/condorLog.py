@@ -0,0 +1,216 @@
+import os
+import re
+import glob
+import time
+import datetime
+
+# reading of condor user logs
+#
+# every event in a user log starts with a header line
+#     005 (1234.000.000) 2020-10-18 12:00:00 Job terminated.
+# followed by indented detail lines and is closed by a line '...'
+
+eventNames = {
+    "000": "submit",
+    "001": "execute",
+    "002": "executableError",
+    "004": "evicted",
+    "005": "terminated",
+    "006": "imageSize",
+    "007": "shadowException",
+    "009": "aborted",
+    "012": "held",
+    "013": "released",
+    }
+
+headerRegex = re.compile(r"^(\d{3}) \((\d+)\.(\d+)\.\d+\) (\S+ \S+) (.*)$")
+returnValueRegex = re.compile(r"Normal termination \(return value (-?\d+)\)")
+signalRegex = re.compile(r"Abnormal termination \(signal (\d+)\)")
+memoryUsageRegex = re.compile(r"^\s*Memory \(MB\)\s*:\s*(\d+)\s+(\d+)")
+imageMemoryRegex = re.compile(r"^\s*(\d+)\s+-\s+MemoryUsage of job \(MB\)")
+
+def parseTime(timestamp):
+    """Seconds since epoch of an event timestamp, in the new (ISO) or old (no year) log format."""
+    try:
+        dt = datetime.datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        dt = datetime.datetime.strptime(timestamp, "%m/%d %H:%M:%S")
+        dt = dt.replace(year = datetime.datetime.now().year)
+    return time.mktime(dt.timetuple())
+
+def parseEvent(lines):
+    """
+    parse the lines of a single event into a dictionary with the keys
+    code, name, cluster, proc, time, text and lines (the detail lines)
+    returns None if the header is not readable
+    """
+    match = headerRegex.match(lines[0])
+    if match is None:
+        return None
+    code = match.group(1)
+    return {
+        "code":     code,
+        "name":     eventNames.get(code, code),
+        "cluster":  int(match.group(2)),
+        "proc":     int(match.group(3)),
+        "time":     parseTime(match.group(4)),
+        "text":     match.group(5).strip(),
+        "lines":    lines[1:],
+        }
+
+def parseEvents(text):
+    """Parse all complete events in text, return the events and the incomplete remainder."""
+    end = text.rfind("\n...\n")
+    if end == -1:
+        return [], text
+    events = []
+    lines = []
+    for line in text[:end+5].splitlines():
+        if line.strip() == "...":
+            if len(lines) > 0:
+                event = parseEvent(lines)
+                if not event is None:
+                    events.append(event)
+            lines = []
+        else:
+            lines.append(line)
+    return events, text[end+5:]
+
+class CondorLogReader:
+    """
+    incrementally read the events of all condor user logs matching patterns
+
+    poll() only reads what was appended to the logs since the last call,
+    new log files matching the patterns are picked up automatically.
+    logs passed to close() (e.g. of jobs in a final status) are not read anymore.
+    """
+    def __init__(self, patterns):
+        if not isinstance(patterns, list):
+            patterns = [patterns]
+        self.patterns = patterns
+        self.offsets = {}
+        self.buffers = {}
+        self.closed = set()
+
+    def files(self):
+        files = []
+        for pattern in self.patterns:
+            files += glob.glob(pattern)
+        return sorted(set(files) - self.closed)
+
+    def close(self, path):
+        self.closed.add(path)
+        self.buffers.pop(path, None)
+
+    def poll(self):
+        events = []
+        for path in self.files():
+            offset = self.offsets.get(path, 0)
+            if os.path.getsize(path) <= offset:
+                continue
+            with open(path, "r") as f:
+                f.seek(offset)
+                text = f.read()
+            self.offsets[path] = offset + len(text)
+            newEvents, self.buffers[path] = parseEvents(self.buffers.get(path, "") + text)
+            for event in newEvents:
+                event["log"] = path
+            events += newEvents
+        return events
+
+finalStatus = ["done", "failed", "removed", "resubmitted"]
+
+class JobTracker:
+    """
+    state of condor jobs following their log events
+
+    jobs is a dictionary (cluster, proc) -> record with the keys
+        status:         idle, running, held, done, failed, removed or resubmitted
+        exitCode:       return value of the job, None if it did not terminate normally
+        signal:         signal that killed the job, if it terminated abnormally
+        submitTime, startTime, endTime (seconds since epoch) and runtime (seconds)
+        memory:         peak memory usage in MB
+        memoryRequest:  requested memory in MB, if reported by the log
+        holdReason:     reason of the last hold
+        log:            path of the log file
+    """
+    def __init__(self):
+        self.jobs = {}
+
+    def _job(self, event):
+        key = (event["cluster"], event["proc"])
+        if not key in self.jobs:
+            self.jobs[key] = {
+                "cluster": event["cluster"], "proc": event["proc"], "status": "idle",
+                "exitCode": None, "signal": None, "submitTime": None, "startTime": None,
+                "endTime": None, "runtime": None, "memory": None, "memoryRequest": None,
+                "holdReason": None, "log": event.get("log")}
+        return self.jobs[key]
+
+    def update(self, events):
+        """Apply events to the job records, return the list of jobs whose status changed."""
+        changed = []
+        for event in events:
+            job = self._job(event)
+            before = job["status"]
+            # a resubmitted job is followed under its new ID
+            if before == "resubmitted":
+                continue
+            name = event["name"]
+            if name == "submit":
+                job["submitTime"] = event["time"]
+            elif name == "execute":
+                job["status"] = "running"
+                job["startTime"] = event["time"]
+            elif name in ["evicted", "released"]:
+                job["status"] = "idle"
+            elif name == "held":
+                job["status"] = "held"
+                if len(event["lines"]) > 0:
+                    job["holdReason"] = event["lines"][0].strip()
+            elif name == "aborted":
+                job["status"] = "removed"
+                job["endTime"] = event["time"]
+            elif name == "imageSize":
+                self._readMemory(job, event)
+            elif name == "terminated":
+                self._terminate(job, event)
+            if not job["status"] == before and not any(job is c for c in changed):
+                changed.append(job)
+        return changed
+
+    def _readMemory(self, job, event):
+        for line in event["lines"]:
+            match = imageMemoryRegex.match(line) or memoryUsageRegex.match(line)
+            if match is None:
+                continue
+            job["memory"] = max(job["memory"] or 0, int(match.group(1)))
+            if match.re is memoryUsageRegex:
+                job["memoryRequest"] = int(match.group(2))
+
+    def _terminate(self, job, event):
+        job["endTime"] = event["time"]
+        if not job["startTime"] is None:
+            job["runtime"] = job["endTime"] - job["startTime"]
+        for line in event["lines"]:
+            match = returnValueRegex.search(line)
+            if not match is None:
+                job["exitCode"] = int(match.group(1))
+            match = signalRegex.search(line)
+            if not match is None:
+                job["signal"] = int(match.group(1))
+        self._readMemory(job, event)
+        job["status"] = "done" if job["exitCode"] == 0 else "failed"
+
+    def resubmitted(self, job):
+        job["status"] = "resubmitted"
+
+    def counts(self):
+        counts = dict((status, 0) for status in ["idle", "running", "held"] + finalStatus)
+        for job in self.jobs.values():
+            counts[job["status"]] += 1
+        return counts
+
+    def finished(self):
+        """True if jobs are tracked and all of them reached a final status."""
+        return len(self.jobs) > 0 and all(job["status"] in finalStatus for job in self.jobs.values())
@@ -2,14 +2,21 @@ import sys
 import os
 import glob
 import numpy as np
-import subprocess 
 import stat
 import re
+import io
+import csv
 import time
+import json
+import hashlib
+import tarfile
+import math
+import datetime
 import optparse
-import sys
 
 import toolbox.printer as printer
+import toolbox.condorLog as condorLog
+import toolbox.batchBackend as batchBackend
 
 submitTemplateNAF = """
 universe = vanilla
@@ -39,30 +46,360 @@ Requirements = ( OpSysAndVer == "CentOS7" )
 RequestMemory = {memory}
 RequestDisk = {disk}
 +RequestWalltime = {runtime}
+Request_Cpus = {ncores}
 JobBatchName = {batchname}
 accounting_group=cms.higgs
 requirements = TARGET.ProvidesIO && TARGET.ProvidesEKPResources
 docker_image = mschnepf/slc7-condocker
 """
 
-def submitToBatch(workdir, list_of_shells, memory_ = "1000", disk_ = "1000000", runtime_ = "43200", ncores_ = "1", use_proxy = False, proxy_dir_ = "", name_ = ""):
-    ''' submit the list of shell script to the NAF batch system '''
+# array script looking up its task in a task index file with fixed width lines,
+# the task is given by SGE_TASK_ID or else by the step number of 'queue N' (from 0)
+compactArrayTemplate = """#!/bin/zsh
+taskindex={index}
+if [ -z "$SGE_TASK_ID" ]; then
+    SGE_TASK_ID=$(( $1 + 1 ))
+fi
+read -r thescript <<< "$(dd if=$taskindex bs={width} skip=$(( SGE_TASK_ID - 1 )) count=1 2>/dev/null)"
+echo "starting dir: $PWD"
+echo "${{thescript}}"
+echo "$SGE_TASK_ID"
+. $thescript
+"""
+compactArguments = " $(Step)"
+
+# array script running its task from the staged tarball in the scratch directory of the job.
+# the environment of the setup is cached once per node and setup, only variables
+# exported by the setup are kept in the cache (in a directory only the user can access)
+stagedArrayTemplate = """#!/bin/zsh
+stagedir=$PWD/{name}staged
+mkdir -p $stagedir
+tar -xzf {tarball} -C $stagedir
+if [ -z "$SGE_TASK_ID" ]; then
+    SGE_TASK_ID=$(( $1 + 1 ))
+fi
+thescript=$stagedir/tasks/$(sed -n "${{SGE_TASK_ID}}p" $stagedir/tasks.txt).sh
+echo "starting dir: $PWD"
+echo "${{thescript}}"
+echo "$SGE_TASK_ID"
+if [ -f $stagedir/setup.sh ]; then
+    # the cache is only used in a private directory owned by the user
+    envdir=/tmp/toolbox_env_$(id -u)
+    mkdir -m 700 $envdir 2> /dev/null
+    if [ -d $envdir -a ! -L $envdir -a -O $envdir ]; then
+        chmod 700 $envdir
+        envcache=$envdir/{setupHash}.sh
+        if [ ! -f $envcache ]; then
+            echo "caching environment of setup in $envcache"
+            (
+                export -p > $envcache.$$.before
+                . $stagedir/setup.sh > /dev/null
+                export -p | grep -vxFf $envcache.$$.before | grep -v -e " PWD=" -e " OLDPWD=" > $envcache.$$
+                rm -f $envcache.$$.before
+                mv $envcache.$$ $envcache
+            )
+        fi
+    fi
+    if [ -n "$envcache" -a -O "$envcache" ]; then
+        . $envcache
+    else
+        echo "no private environment cache available - running setup"
+        . $stagedir/setup.sh
+    fi
+fi
+( . $thescript )
+taskstatus=$?
+rm -rf $stagedir
+exit $taskstatus
+"""
+
+cmsswSetupTemplate = """export VO_CMS_SW_DIR=/cvmfs/cms.cern.ch
+source $VO_CMS_SW_DIR/cmsset_default.sh
+cd {cmssw}/src
+eval `scram runtime -sh`
+cd -"""
+
+def submitToBatch(workdir, list_of_shells, memory_ = "1000", disk_ = "1000000", runtime_ = "43200", ncores_ = "1", use_proxy = False, proxy_dir_ = "", name_ = "",
+        packSize = None, packRuntime = None, runtimes = None, parallel = False, estimate = False, margin = 1.3, compact = False,
+        stage = False, setup = None):
+    ''' 
+        submit the list of shell script to the NAF batch system 
+
+        with packSize or packRuntime several scripts are run in one job (see packScripts),
+        in parallel on ncores_ cores if parallel is set
+        with estimate the memory and runtime of every task are requested from earlier
+        jobs in workdir (see estimateResources), memory_ and runtime_ are the defaults
+        with compact the tasks are queued with 'queue N' and looked up in a task index
+        file instead of being listed in the submit file and array script (see writeArrayScript)
+        with stage the scripts and the shell code setup (e.g. cmsswSetupTemplate) are
+        transferred to the jobs in one tarball (see stageScripts)
+    '''
+    taskResources = None
+    if estimate:
+        resources = estimateResources(workdir, list_of_shells, margin, memory_, runtime_)
+        if runtimes is None:
+            runtimes = dict((f, r[1]) for f, r in resources.items())
+
+    # run several scripts per job
+    if packSize or packRuntime:
+        nparallel = int(ncores_) if parallel else 1
+        packs = packScripts(workdir, list_of_shells, packSize, packRuntime, runtimes, nparallel, name_)
+        if estimate:
+            resources = _packResources(workdir, packs, resources, nparallel, name_)
+        list_of_shells = packs
+
+    if estimate:
+        taskResources = dict((i+1, resources[os.path.abspath(f)]) for i, f in enumerate(list_of_shells))
 
     # write array script for submission
-    arrayScript = writeArrayScript(workdir, list_of_shells, name_)
+    arrayScript = writeArrayScript(workdir, list_of_shells, name_, compact = compact, stage = stage, setup = setup)
 
     # write submit script for submission
-    submitScript = writeSubmitScript(workdir, arrayScript, len(list_of_shells), memory_, disk_, runtime_, ncores_, use_proxy, proxy_dir_, name_)
+    submitScript = writeSubmitScript(workdir, arrayScript, len(list_of_shells), memory_, disk_, runtime_, ncores_, use_proxy, proxy_dir_, name_,
+        taskResources = taskResources, compact = compact, stage = stage)
         
     # submit the whole thing
     jobID = condorSubmit( submitScript)
+
+    # keep track of the submission for resubmissions
+    info = _submissionInfo(arrayScript, list_of_shells,
+        memory_, disk_, runtime_, ncores_, use_proxy, proxy_dir_, name_)
+    if not taskResources is None:
+        info["taskResources"] = dict((str(t), r) for t, r in taskResources.items())
+    info["stage"] = stage
+    recordSubmission(workdir, jobID, info)
     return [jobID]
 
-def writeArrayScript(workdir, files, name_):
+def submitGroupsToBatch(workdir, groups, memory_ = "1000", disk_ = "1000000", runtime_ = "43200", ncores_ = "1", use_proxy = False, proxy_dir_ = "", name_ = "", compact = False,
+        stage = False, setup = None):
+    '''
+        submit several groups of shell scripts with a single condor_submit call
+
+        groups: dictionary group name -> list of shell scripts, or
+                group name -> dictionary with the list of 'scripts' and
+                optionally its own 'memory', 'disk', 'runtime' and 'ncores'
+        the remaining arguments are the defaults for all groups,
+        compact queues every group with 'queue N' and stage transfers the scripts
+        of every group in a tarball (see submitToBatch)
+
+        groups may share a cluster (condor_submit queues all of them in one), so the jobs of a group are
+        identified by their 'cluster.proc' IDs, which can be passed to
+        monitorJobStatus or condorAsync.ClusterMonitor like cluster IDs
+
+        returns a dictionary group name -> list of 'cluster.proc' job IDs,
+        empty groups are not submitted and get an empty list
+    '''
+    parts = []
+    code = ""
+    jobIDs = {}
+    for group in sorted(groups):
+        settings = groups[group]
+        if isinstance(settings, list):
+            settings = {"scripts": settings}
+        scripts = settings["scripts"]
+        if len(scripts) == 0:
+            printer.printWarning("no scripts in group {} - not submitting it".format(group))
+            jobIDs[group] = []
+            continue
+        groupName = name_+group
+        arrayScript = writeArrayScript(workdir, scripts, groupName, compact = compact, stage = stage, setup = setup)
+        info = _submissionInfo(arrayScript, scripts,
+            settings.get("memory", memory_), settings.get("disk", disk_),
+            settings.get("runtime", runtime_), settings.get("ncores", ncores_),
+            use_proxy, proxy_dir_, groupName)
+        info["stage"] = stage
+        code += _submitDescription(workdir, arrayScript, info["memory"], info["disk"],
+            info["runtime"], info["ncores"], use_proxy, proxy_dir_, groupName,
+            arguments = compactArguments if compact else "",
+            transferInputs = stagedInputs(arrayScript) if stage else None)
+        if compact:
+            code += "\nQueue {}\n".format(len(scripts))
+        else:
+            code += _queueStatement(info["taskIDs"])+"\n"
+        parts.append((group, info))
+
+    if len(parts) == 0:
+        printer.printError("no scripts to submit in any group")
+        return jobIDs
+
+    path = workdir+"/"+name_+"_bulkSubmitScript.sub"
+    with open(path, "w") as f:
+        f.write(code)
+
+    # assign the submitted jobs to the groups in the order they were queued
+    procs = []
+    for cluster, first, last in condorSubmitTerse(path):
+        procs += [(cluster, proc) for proc in range(first, last+1)]
+
+    offset = 0
+    for group, info in parts:
+        cluster, firstProc = procs[offset]
+        info["firstProc"] = firstProc
+        recordSubmission(workdir, cluster, info)
+        jobIDs[group] = ["{}.{}".format(c, p) for c, p in procs[offset:offset+len(info["taskIDs"])]]
+        offset += len(info["taskIDs"])
+    return jobIDs
+
+def _submissionInfo(arrayScript, scripts, memory_, disk_, runtime_, ncores_, use_proxy, proxy_dir_, name_):
+    return {
+        "name":         name_,
+        "arrayScript":  os.path.abspath(arrayScript),
+        "scripts":      [os.path.abspath(f) for f in scripts],
+        "taskIDs":      list(range(1, len(scripts)+1)),
+        "firstProc":    0,
+        "memory":       memory_,
+        "disk":         disk_,
+        "runtime":      runtime_,
+        "ncores":       ncores_,
+        "use_proxy":    use_proxy,
+        "proxy_dir":    proxy_dir_,
+        "retry":        0,
+        }
+
+def submissionsPath(workdir):
+    return os.path.abspath(workdir+"/submissions.json")
+
+def loadSubmissions(workdir):
+    ''' 
+        submissions recorded in workdir as dictionary cluster ID (as string) -> list of
+        submission infos, one for every array script queued in the cluster
+    '''
+    path = submissionsPath(workdir)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def recordSubmission(workdir, jobID, info):
+    submissions = loadSubmissions(workdir)
+    submissions.setdefault(str(jobID), []).append(info)
+    path = submissionsPath(workdir)
+    with open(path+".tmp", "w") as f:
+        json.dump(submissions, f, indent = 1, sort_keys = True)
+    os.rename(path+".tmp", path)
+
+def findSubmission(submissions, cluster, proc):
+    ''' submission info and task index of job cluster.proc, (None, None) if it is not recorded '''
+    for info in submissions.get(str(cluster), []):
+        index = proc - info["firstProc"]
+        if 0 <= index < len(info["taskIDs"]):
+            return info, index
+    return None, None
+
+packTemplate = """
+# packed scripts of {name}, exit status of every script is written to
+# {status}
+: > {status}
+npacked=0
+nfailed=0
+for thescript in {scripts}; do
+    while [ $(jobs -r | wc -l) -ge {ncores} ]; do sleep 1; done
+    ( ( . $thescript ); echo "$? $thescript" >> {status} ) &
+done
+wait
+while read code thescript; do
+    npacked=$((npacked+1))
+    [ "$code" -eq 0 ] || nfailed=$((nfailed+1))
+done < {status}
+echo "$npacked scripts finished, $nfailed failed"
+[ $nfailed -eq 0 ] && [ $npacked -eq {nscripts} ]
+"""
+
+def packScripts(workdir, scripts, packSize = None, packRuntime = None, runtimes = None, ncores = 1, name_ = ""):
+    '''
+        pack scripts into fewer shell scripts that each run several of them
+
+        scripts are packed by count (packSize) or, if packRuntime is given, up to
+        packRuntime per pack following runtimes, a dictionary script -> expected
+        runtime in seconds. scripts without a runtime fill a whole pack, without
+        any runtimes packSize is used if given.
+        each pack runs up to ncores of its scripts at a time and writes the exit
+        status of every script to a .status file next to it (see failedPackedScripts).
+        the pack exits with a non-zero status if any of its scripts failed.
+
+        returns the list of pack scripts
+    '''
+    scripts = [os.path.abspath(f) for f in scripts]
+    packs = []
+    if packRuntime and not runtimes:
+        if packSize:
+            printer.printWarning("no runtimes to pack scripts up to {} s - packing {} scripts per job".format(packRuntime, packSize))
+        else:
+            printer.printWarning("no runtimes to pack scripts up to {} s - every script fills a pack".format(packRuntime))
+    if packRuntime and (runtimes or not packSize):
+        runtimes = runtimes or {}
+        load = 0
+        for f in scripts:
+            runtime = runtimes.get(f, packRuntime)
+            if len(packs) == 0 or load + runtime > packRuntime:
+                packs.append([])
+                load = 0
+            packs[-1].append(f)
+            load += runtime
+    else:
+        packSize = int(packSize or 1)
+        packs = [scripts[i:i+packSize] for i in range(0, len(scripts), packSize)]
+
+    packdir = os.path.abspath(workdir+"/packs")
+    if not os.path.exists(packdir):
+        os.makedirs(packdir)
+
+    index = {}
+    paths = []
+    for i, pack in enumerate(packs):
+        path = packdir+"/{}pack_{}.sh".format(name_, i)
+        status = path.replace(".sh", ".status")
+        with open(path, "w") as f:
+            f.write(packTemplate.format(name = name_, status = status, scripts = " ".join(pack),
+                ncores = int(ncores), nscripts = len(pack)))
+        st = os.stat(path)
+        os.chmod(path, st.st_mode | stat.S_IEXEC)
+        index[path] = {"scripts": pack, "status": status}
+        paths.append(path)
+
+    with open(packdir+"/{}packs.json".format(name_), "w") as f:
+        json.dump(index, f, indent = 1, sort_keys = True)
+    printer.printInfo("packed {} scripts into {} jobs".format(len(scripts), len(packs)))
+    return paths
+
+def failedPackedScripts(workdir, name_ = ""):
+    ''' 
+        scripts of packs submitted from workdir that failed or did not run,
+        these can be submitted again with submitToBatch
+    '''
+    path = os.path.abspath(workdir+"/packs/{}packs.json".format(name_))
+    with open(path, "r") as f:
+        index = json.load(f)
+
+    failed = []
+    for pack in sorted(index):
+        codes = {}
+        if os.path.exists(index[pack]["status"]):
+            with open(index[pack]["status"], "r") as f:
+                for line in f:
+                    code, script = line.split(" ", 1)
+                    codes[script.strip()] = int(code)
+        failed += [script for script in index[pack]["scripts"] if not codes.get(script) == 0]
+    return failed
+
+def writeArrayScript(workdir, files, name_, compact = False, stage = False, setup = None):
+    '''
+        with compact the scripts are not listed in the array script but
+        looked up in the task index file (see writeTaskIndex)
+        with stage they are run from the tarball written by stageScripts
+    '''
     path = os.path.abspath(workdir+"/"+name_+"_arraySubmit.sh")
     files = [os.path.abspath(f) for f in files]
-    
-    code = """
+
+    if stage:
+        tarball, setupHash = stageScripts(path, files, setup)
+        code = stagedArrayTemplate.format(name = name_, tarball = os.path.basename(tarball),
+            setupHash = setupHash)
+    elif compact:
+        index, width = writeTaskIndex(workdir, files, name_)
+        code = compactArrayTemplate.format(index = index, width = width)
+    else:
+        code = """
 #!/bin/bash
 subtasklist=(
 %(tasks)s
@@ -84,8 +421,100 @@ echo "$SGE_TASK_ID"
     return path
 
 
-def writeSubmitScript(workdir, arrayScript, nScripts, memory_, disk_, runtime_, ncores_, use_proxy, proxy_dir_, name_):
+def stagedInputs(arrayScript):
+    ''' files transferred to the jobs of a staged array script '''
+    return [arrayScript.replace("_arraySubmit.sh", "_staged.tar.gz"), arrayScript]
+
+def stageScripts(arrayScript, files, setup = None):
+    '''
+        bundle the scripts of an array script and the shell code setup into one
+        compressed tarball that is transferred to every job, such that the jobs
+        do not read their scripts from the shared file system
+
+        scripts with the same content are stored only once (as tasks/<sha1>.sh),
+        tasks.txt lists the script of every task. scripts run by the tasks
+        themselves (e.g. the members of packs) are not staged.
+
+        returns the path of the tarball and the hash of the setup
+    '''
+    tarball = stagedInputs(arrayScript)[0]
+    index = []
+    contents = {}
+    for f in files:
+        with open(f, "rb") as script:
+            content = script.read()
+        digest = hashlib.sha1(content).hexdigest()
+        contents[digest] = content
+        index.append(digest)
+
+    def addFile(tar, name, content):
+        member = tarfile.TarInfo(name)
+        member.size = len(content)
+        member.mode = 0o755
+        member.mtime = time.time()
+        tar.addfile(member, io.BytesIO(content))
+
+    setupHash = "none"
+    with tarfile.open(tarball, "w:gz") as tar:
+        addFile(tar, "tasks.txt", ("\n".join(index)+"\n").encode())
+        for digest in sorted(contents):
+            addFile(tar, "tasks/{}.sh".format(digest), contents[digest])
+        if setup:
+            setup = setup.encode()
+            setupHash = hashlib.sha1(setup).hexdigest()
+            addFile(tar, "setup.sh", setup)
+    printer.printInfo("staged {} scripts ({} distinct) in {} ({:.1f} kB)".format(
+        len(files), len(contents), tarball, os.path.getsize(tarball)/1e3))
+    return tarball, setupHash
+
+def writeTaskIndex(workdir, files, name_):
+    '''
+        write the scripts to the task index file, one per line padded to the same width,
+        such that the script of task i is found at offset (i-1)*width
+
+        returns the path of the index and the width of its lines
+    '''
+    path = os.path.abspath(workdir+"/"+name_+"_tasks.idx")
+    width = max(len(f) for f in files)+1
+    with open(path, "w") as f:
+        for script in files:
+            f.write(script.ljust(width-1)+"\n")
+    return path, width
+
+def writeSubmitScript(workdir, arrayScript, nScripts, memory_, disk_, runtime_, ncores_, use_proxy, proxy_dir_, name_, taskIDs = None, taskResources = None, compact = False, stage = False):
+    '''
+        taskResources: optional dictionary task ID -> (memory, runtime) requested
+            per task instead of memory_ and runtime_
+        compact: queue all tasks with 'queue N', the array script derives the task
+            from the step number (needs an array script written with compact).
+            only used if neither taskIDs nor taskResources are given
+        stage: transfer the staged tarball to the jobs (needs an array script written with stage)
+    '''
     path = workdir+"/"+name_+"_submitScript.sub"
+
+    if not taskResources is None:
+        memory_ = "$(TaskMemory)"
+        runtime_ = "$(TaskRuntime)"
+    compact = compact and taskIDs is None and taskResources is None
+    code = _submitDescription(workdir, arrayScript, memory_, disk_, runtime_, ncores_, use_proxy, proxy_dir_, name_,
+        arguments = compactArguments if compact else "",
+        transferInputs = stagedInputs(arrayScript) if stage else None)
+
+    # by default all tasks of the array script are queued
+    if compact:
+        code += "\nQueue {}".format(nScripts)
+    else:
+        if taskIDs is None:
+            taskIDs = range(1, nScripts+1)
+        code += _queueStatement(taskIDs, taskResources)
+
+    with open(path, "w") as f:
+        f.write(code)
+
+    #print("wrote submit script "+str(path))
+    return path
+
+def _submitDescription(workdir, arrayScript, memory_, disk_, runtime_, ncores_, use_proxy, proxy_dir_, name_, arguments = "", transferInputs = None):
     logdir = workdir+"/logs"
     if not os.path.exists(logdir):
         os.makedirs(logdir)
@@ -97,7 +526,7 @@ def writeSubmitScript(workdir, arrayScript, nScripts, memory_, disk_, runtime_,
         code += submitTemplateETP
 
     code = code.format(
-        arg = os.path.abspath(arrayScript),
+        arg = (os.path.basename(arrayScript) if transferInputs else os.path.abspath(arrayScript))+arguments,
         dir = os.path.abspath(logdir),
         memory = memory_,
         disk = disk_,
@@ -106,95 +535,426 @@ def writeSubmitScript(workdir, arrayScript, nScripts, memory_, disk_, runtime_,
         ncores = ncores_,
         batchname = name_.replace(".txt",""))
 
+    # staged jobs get their inputs transferred into the scratch directory
+    if transferInputs:
+        code += """should_transfer_files = YES
+when_to_transfer_output = ON_EXIT
+transfer_input_files = {}
+""".format(",".join(os.path.abspath(f) for f in transferInputs))
+
     if use_proxy:
         code+="""
 environment = X509_USER_PROXY={proxy_dir}
 getenv = True
 use_x509userproxy = True
 x509userproxy = {proxy_dir}""".format(proxy_dir = proxy_dir_)
+    return code
 
-    code+="""
+def _queueStatement(taskIDs, taskResources = None):
+    if taskResources is None:
+        code = """
 Queue Environment From (
 """
-    for taskID in range(nScripts):
-        code += "\"SGE_TASK_ID="+str(taskID+1)+"\"\n"
+        for taskID in taskIDs:
+            code += "\"SGE_TASK_ID="+str(taskID)+"\"\n"
+    else:
+        code = """
+Queue Environment, TaskMemory, TaskRuntime From (
+"""
+        for taskID in taskIDs:
+            memory, runtime = taskResources[taskID]
+            code += "\"SGE_TASK_ID={}\" {} {}\n".format(taskID, memory, runtime)
     code += ")"
+    return code
 
-    with open(path, "w") as f:
-        f.write(code)
+def scriptPattern(script):
+    ''' name pattern of a script to share resource estimates, e.g. skim_ttbar_12.sh -> skim_ttbar_*.sh '''
+    return re.sub(r"[0-9]+", "*", os.path.basename(script))
 
-    #print("wrote submit script "+str(path))
-    return path
+def learnResources(workdir):
+    '''
+        peak memory (MB) and wall time (s) per script name pattern of all
+        successfully finished jobs submitted from workdir, from their condor user logs
+
+        returns a dictionary pattern -> {"memory", "runtime", "jobs"}
+    '''
+    reader = condorLog.CondorLogReader(os.path.abspath(workdir+"/logs")+"/*.log")
+    tracker = condorLog.JobTracker()
+    tracker.update(reader.poll())
+    submissions = loadSubmissions(workdir)
+
+    learned = {}
+    for job in tracker.jobs.values():
+        if not job["status"] == "done":
+            continue
+        info, index = findSubmission(submissions, job["cluster"], job["proc"])
+        if info is None:
+            continue
+        script = info["scripts"][info["taskIDs"][index]-1]
+        # packs are estimated from their scripts
+        if "/packs/" in script:
+            continue
+        entry = learned.setdefault(scriptPattern(script), {"memory": 0, "runtime": 0, "jobs": 0})
+        entry["memory"] = max(entry["memory"], job["memory"] or 0)
+        entry["runtime"] = max(entry["runtime"], job["runtime"] or 0)
+        entry["jobs"] += 1
+    return learned
+
+def estimateResources(workdir, scripts, margin = 1.3, memory_ = "1000", runtime_ = "43200", minMemory = 500, minRuntime = 600):
+    '''
+        memory (MB) and runtime (s) to request for every script, learned from earlier
+        jobs with the same name pattern in workdir (see learnResources) times margin.
+        scripts without earlier jobs get memory_ and runtime_
+
+        returns a dictionary script -> (memory, runtime)
+    '''
+    learned = learnResources(workdir)
+    resources = {}
+    nLearned = 0
+    for f in scripts:
+        f = os.path.abspath(f)
+        entry = learned.get(scriptPattern(f))
+        if entry is None:
+            resources[f] = (int(memory_), int(runtime_))
+            continue
+        nLearned += 1
+        # round up to 100 MB and full minutes
+        memory = max(int(math.ceil(entry["memory"]*margin/100.)*100), minMemory)
+        runtime = max(int(math.ceil(entry["runtime"]*margin/60.)*60), minRuntime)
+        resources[f] = (memory, runtime)
+    printer.printInfo("estimated resources of {} of {} scripts from earlier jobs".format(nLearned, len(scripts)))
+    return resources
+
+def _packResources(workdir, packs, resources, nparallel, name_):
+    ''' memory and runtime of packs from the estimates of their scripts '''
+    with open(os.path.abspath(workdir+"/packs/{}packs.json".format(name_)), "r") as f:
+        index = json.load(f)
+    packResources = {}
+    for pack in packs:
+        members = [resources[script] for script in index[pack]["scripts"]]
+        memory = max(m for m, _ in members)*min(nparallel, len(members))
+        runtime = max(max(r for _, r in members), sum(r for _, r in members)//nparallel)
+        packResources[pack] = (memory, runtime)
+    return packResources
+
+def condorSubmitTerse(submitPath):
+    '''
+        submit the submit file with the scheduler backend (see batchBackend.setBackend),
+        by default condor_submit -terse with retries and exponential backoff
+
+        returns a list of (cluster, first ProcId, last ProcId) of the submitted jobs
+    '''
+    return batchBackend.getBackend().submit(submitPath)
 
 def condorSubmit(submitPath):
-    submitCommand = "condor_submit -terse "+ submitPath
-    printer.printCommand("submitting {}".format(submitCommand))
-    tries = 0
-    jobID = None
-    while not jobID:
-        process = subprocess.Popen(submitCommand.split(), stdout = subprocess.PIPE, stderr = subprocess.STDOUT, stdin = subprocess.PIPE)
-        process.wait()
-        output = process.communicate()
-        try:
-            jobID = int(output[0].split(".")[0])
-        except:
-            print("something went wrong with calling the condir_submit command, submission of jobs was not successful")
-            print("DEBUG:")
-            print(output)
-            tries += 1
-            jobID = None
-            time.sleep(60)
-        if tries>10:
-            print("job submission was not successful after ten tries - exiting without JOBID")
-            sys.exit(-1)
-    return jobID
-
-
-
-
-def monitorJobStatus(jobIDs = None, queryInterval = 60, nTotalJobs = None):
+    return condorSubmitTerse(submitPath)[0][0]
+
+
+
+
+def logPatterns(workdir, jobIDs):
+    ''' patterns of the condor user logs writeSubmitScript sets up for the jobs ('cluster' or 'cluster.proc') in workdir '''
+    logdir = os.path.abspath(workdir+"/logs")
+    patterns = []
+    for jobID in jobIDs:
+        cluster, proc = batchBackend._splitJobID(jobID)
+        patterns.append(logdir+"/*submitScript.{}_{}.log".format(cluster, "*" if proc is None else proc))
+    return patterns
+
+def printJobCounts(counts, nTotalJobs = None):
+    nrunning = counts["running"] + counts["idle"] + counts["held"]
+    printLine = "\033[1;32m{:4d} running\033[0m | \033[1;33m{:4d} idling\033[0m | "
+    printLine+= "\033[1;31m{:4d} held\033[0m |\t \033[1;34mtotal: {:4d}\033[0m"
+    printLine = printLine.format(
+                    counts["running"], counts["idle"], counts["held"], nrunning)
+    if not nTotalJobs is None:
+        printLine+= "/\033[1;34m{}\033[0m".format(nTotalJobs)
+    if "done" in counts:
+        printLine+= " | \033[1;32m{:4d} done\033[0m | \033[1;31m{:4d} failed\033[0m".format(
+            counts["done"], counts["failed"] + counts["removed"])
+    if counts.get("resubmitted"):
+        printLine+= " | \033[1;33m{:4d} resubmitted\033[0m".format(counts["resubmitted"])
+    print(printLine)
+
+def _bumpResources(job, info, taskID, memoryFactor, runtimeFactor, maxMemory, maxRuntime):
+    ''' memory and runtime request for the resubmission of a failed or held job '''
+    memory = int(info["memory"])
+    runtime = int(info["runtime"])
+    if "taskResources" in info:
+        memory, runtime = info["taskResources"][str(taskID)]
+    reason = (job["holdReason"] or "").lower()
+    if "memory" in reason or (job["memory"] and job["memory"] >= 0.9*memory):
+        memory = min(int(memory*memoryFactor), int(maxMemory))
+    if "time" in reason or (job["runtime"] and job["runtime"] >= 0.9*runtime):
+        runtime = min(int(runtime*runtimeFactor), int(maxRuntime))
+    return memory, runtime
+
+def resubmitJobs(workdir, jobs, maxRetries = 3, memoryFactor = 1.5, runtimeFactor = 1.5, maxMemory = 16000, maxRuntime = 172800):
+    '''
+        resubmit the array tasks of failed or held jobs (records of condorLog.JobTracker)
+        submitted with submitToBatch from workdir.
+
+        held jobs are removed first. the memory request is raised by memoryFactor if the
+        job was held for its memory or used at least 90% of it, the runtime likewise.
+        tasks that were already resubmitted maxRetries times are not resubmitted again.
+
+        returns the list of new job IDs and the list of resubmitted jobs
+    '''
+    submissions = loadSubmissions(workdir)
+    groups = {}
+    resubmitted = []
+    for job in jobs:
+        info, index = findSubmission(submissions, job["cluster"], job["proc"])
+        if info is None:
+            printer.printWarning("job {}.{} was not submitted from {} - not resubmitting".format(
+                job["cluster"], job["proc"], workdir))
+            continue
+        taskID = info["taskIDs"][index]
+        # held jobs would stay in the queue forever
+        if job["status"] == "held":
+            batchBackend.getBackend().remove(["{}.{}".format(job["cluster"], job["proc"])])
+        if info["retry"] >= maxRetries:
+            printer.printError("task {} of {} failed after {} retries - giving up".format(
+                taskID, info["name"], info["retry"]))
+            continue
+        memory, runtime = _bumpResources(job, info, taskID, memoryFactor, runtimeFactor, maxMemory, maxRuntime)
+        key = (str(job["cluster"]), info["firstProc"], memory, runtime)
+        groups.setdefault(key, []).append((info, taskID))
+        resubmitted.append(job)
+
+    jobIDs = []
+    for (cluster, firstProc, memory, runtime), tasks in sorted(groups.items()):
+        info = dict(tasks[0][0])
+        taskIDs = [taskID for _, taskID in tasks]
+        info.pop("taskResources", None)
+        info["firstProc"] = 0
+        info["retry"] += 1
+        info["memory"] = str(memory)
+        info["runtime"] = str(runtime)
+        info["taskIDs"] = taskIDs
+        name = "{}_retry{}_{}".format(info["name"], info["retry"], cluster)
+        printer.printAction("resubmitting {} tasks of {} with {} MB memory and {} s runtime".format(
+            len(taskIDs), info["name"], memory, runtime))
+        submitScript = writeSubmitScript(workdir, info["arrayScript"], len(taskIDs), info["memory"],
+            info["disk"], info["runtime"], info["ncores"], info["use_proxy"], info["proxy_dir"], name,
+            taskIDs = taskIDs, stage = info.get("stage", False))
+        jobID = condorSubmit(submitScript)
+        recordSubmission(workdir, jobID, info)
+        jobIDs.append(jobID)
+    return jobIDs, resubmitted
+
+class JobStatistics:
+    '''
+        time series of the job counts while monitoring jobs
+
+        from the series the completion rate (finished jobs per minute in the last
+        window seconds) and the ETA of the remaining jobs are computed, and if
+        runtimes of finished jobs are known, their distribution.
+        the series can be written to csv or json.
+    '''
+    def __init__(self, nTotalJobs = None, window = 600):
+        self.nTotalJobs = nTotalJobs
+        self.window = window
+        self.times = []
+        self.runs = []
+        self.idles = []
+        self.helds = []
+        self.totals = []
+        self.finished = []
+        self.runtimes = []
+
+    def record(self, counts, nFinished = None, runtimes = None):
+        '''
+            add the current counts of running, idle and held jobs.
+            without nFinished, finished jobs are derived from the decrease of queued jobs
+        '''
+        total = counts["running"] + counts["idle"] + counts["held"]
+        if nFinished is None:
+            if not self.nTotalJobs is None:
+                nFinished = int(self.nTotalJobs) - total
+            else:
+                nFinished = max(self.totals + [total]) - total
+        self.times.append(time.time())
+        self.runs.append(counts["running"])
+        self.idles.append(counts["idle"])
+        self.helds.append(counts["held"])
+        self.totals.append(total)
+        self.finished.append(nFinished)
+        if not runtimes is None:
+            self.runtimes = sorted(runtimes)
+
+    def rate(self):
+        ''' finished jobs per minute in the last window seconds '''
+        if len(self.times) < 2:
+            return 0.
+        first = 0
+        while self.times[first] < self.times[-1] - self.window and first < len(self.times)-2:
+            first += 1
+        duration = self.times[-1] - self.times[first]
+        if duration <= 0:
+            return 0.
+        return 60.*(self.finished[-1] - self.finished[first])/duration
+
+    def eta(self):
+        ''' seconds until the queued jobs are finished at the current rate, None if unknown '''
+        rate = self.rate()
+        if rate <= 0 or len(self.totals) == 0:
+            return None
+        return 60.*self.totals[-1]/rate
+
+    def percentile(self, q):
+        if len(self.runtimes) == 0:
+            return None
+        index = int(math.ceil(q/100.*len(self.runtimes)))-1
+        return self.runtimes[max(index, 0)]
+
+    def summary(self):
+        def duration(seconds):
+            return "-" if seconds is None else str(datetime.timedelta(seconds = int(seconds)))
+        line = "\033[1;34m{:6.1f} jobs/min\033[0m | ETA {}".format(self.rate(), duration(self.eta()))
+        if len(self.runtimes) > 0:
+            line += " | runtime p50 {} p90 {} p99 {} max {} ({} jobs)".format(
+                duration(self.percentile(50)), duration(self.percentile(90)),
+                duration(self.percentile(99)), duration(self.runtimes[-1]), len(self.runtimes))
+        return line
+
+    def write(self, path):
+        ''' write the time series to path, as json if it ends with .json and csv otherwise '''
+        columns = ["time", "running", "idle", "held", "queued", "finished"]
+        rows = list(zip(self.times, self.runs, self.idles, self.helds, self.totals, self.finished))
+        with open(path, "w") as f:
+            if path.endswith(".json"):
+                json.dump({
+                    "series":   [dict(zip(columns, row)) for row in rows],
+                    "runtimes": self.runtimes,
+                    }, f, indent = 1)
+            else:
+                writer = csv.writer(f)
+                writer.writerow(columns)
+                writer.writerows(rows)
+
+def _timeseriesPath(workdir, jobIDs, timeseries):
+    ''' path of the job status time series in format timeseries ('csv' or 'json') '''
+    if timeseries is None:
+        return None
+    name = "jobStatus_{}.{}".format(jobIDs[0] if jobIDs else "all", timeseries)
+    return os.path.join(workdir or ".", name)
+
+def monitorJobLogs(jobIDs, workdir, nTotalJobs = None, pollInterval = 5, fallbackAfter = 120, maxRetries = 0, timeseries = None, **resubmitOptions):
+    '''
+        monitoring of jobs by following the events in their condor user logs.
+        the logs are read incrementally every pollInterval seconds and
+        the monitoring ends as soon as all jobs terminated.
+
+        with maxRetries > 0 failed or held tasks are resubmitted right away
+        (see resubmitJobs, which also takes the resubmitOptions) and followed as well
+
+        completion rate, ETA and runtimes of finished jobs are printed along the
+        job counts, with timeseries ('csv' or 'json') they are also written to workdir
+
+        returns the JobTracker with the state of all jobs, or None if no
+        logs showed up within fallbackAfter seconds
+    '''
+    printer.printAction( "following job logs in {}/logs ...".format(workdir),1)
+    reader = condorLog.CondorLogReader(logPatterns(workdir, jobIDs))
+    tracker = condorLog.JobTracker()
+    stats = JobStatistics(nTotalJobs)
+    statsPath = _timeseriesPath(workdir, jobIDs, timeseries)
+    sTime = time.time()
+    # clusters of resubmitted jobs and the number of jobs queued in them
+    retryClusters = set()
+    nRetried = 0
+    while True:
+        changed = tracker.update(reader.poll())
+        # the logs of jobs in a final status do not change anymore
+        for job in changed:
+            if job["status"] in condorLog.finalStatus and not job["log"] is None:
+                reader.close(job["log"])
+        if len(tracker.jobs) == 0:
+            if time.time() - sTime > fallbackAfter:
+                printer.printWarning("no job logs found after {} seconds".format(fallbackAfter))
+                return None
+        elif len(changed) > 0:
+            for job in changed:
+                if job["status"] == "failed":
+                    printer.printWarning("job {}.{} failed with exit code {} (signal {})".format(
+                        job["cluster"], job["proc"], job["exitCode"], job["signal"]))
+                elif job["status"] == "held":
+                    printer.printWarning("job {}.{} held: {}".format(
+                        job["cluster"], job["proc"], job["holdReason"]))
+
+            failed = [job for job in changed if job["status"] in ["failed", "held"]]
+            if maxRetries > 0 and len(failed) > 0:
+                newIDs, resubmitted = resubmitJobs(workdir, failed, maxRetries, **resubmitOptions)
+                reader.patterns += logPatterns(workdir, newIDs)
+                retryClusters.update(batchBackend._splitJobID(j)[0] for j in newIDs)
+                nRetried += len(resubmitted)
+                for job in resubmitted:
+                    tracker.resubmitted(job)
+                if not nTotalJobs is None:
+                    nTotalJobs = int(nTotalJobs) + len(resubmitted)
+            counts = tracker.counts()
+            printJobCounts(counts, nTotalJobs)
+
+            stats.record(counts, counts["done"] + counts["failed"] + counts["removed"],
+                [job["runtime"] for job in tracker.jobs.values() if job["status"] == "done" and not job["runtime"] is None])
+            print(stats.summary())
+            if not statsPath is None:
+                stats.write(statsPath)
+
+        # wait for the logs of all resubmitted jobs before deciding that all jobs are finished
+        nTracked = len(tracker.jobs)
+        nMissing = nRetried - len([key for key in tracker.jobs if key[0] in retryClusters])
+        if nMissing <= 0 and tracker.finished() and (nTotalJobs is None or nTracked >= int(nTotalJobs)):
+            printer.printAction("waiting on no more jobs - exiting loop")
+            return tracker
+        time.sleep(pollInterval)
+
+def monitorJobStatus(jobIDs = None, queryInterval = 60, nTotalJobs = None, workdir = None, maxRetries = 0, timeseries = None, **resubmitOptions):
     ''' 
-        monitoring of jobs via condor_q function. 
+        monitoring of jobs via condor_q function (or the query of the scheduler backend). 
         Loops condor_q output until all scripts have been terminated
 
-        jobIDs: list of IDs of jobs to be monitored 
+        jobIDs: list of IDs of jobs to be monitored, 'cluster' or 'cluster.proc'
             (if no argument is given, all jobs of the current NAF user are monitored)
+        workdir: directory passed to submitToBatch. if given, the job logs
+            are followed instead (see monitorJobLogs) and condor_q
+            is only used if no logs are found
+        maxRetries: number of automatic resubmissions of failed or held tasks
+            (only when following the job logs, see resubmitJobs)
+        timeseries: 'csv' or 'json' to write the job counts over time
+            to workdir (see JobStatistics)
     
     no return 
     '''
+    if jobIDs and not workdir is None:
+        tracker = monitorJobLogs(jobIDs, workdir, nTotalJobs, maxRetries = maxRetries,
+            timeseries = timeseries, **resubmitOptions)
+        if not tracker is None:
+            printer.printInfo("all jobs are finished - exiting monitorJobStatus")
+            return
+        printer.printWarning("falling back to condor_q")
 
     allfinished=False
     errorcount = 0
-    printer.printAction( "checking job status in condor_q ...",1)
-    command = ["condor_q"]
-    # adding jobIDs to command
-    if jobIDs:
-        command += jobIDs
-        command = [str(c) for c in command]
-    command += ["-totals"]#, "|", "grep", "'Total for query'"]
+    backend = batchBackend.getBackend()
+    printer.printAction( "checking job status in {} queue ...".format(backend.name),1)
     sTime = time.time()
 
     # counts
-    times = []
-    runs = []
-    idles = []
-    helds = []
-    totals = []
+    stats = JobStatistics(nTotalJobs)
+    statsPath = _timeseriesPath(workdir, jobIDs, timeseries)
     while not allfinished:
         time.sleep(queryInterval)
-        # calling condor_q command
-        a = subprocess.Popen(command, 
-            stdout=subprocess.PIPE,stderr=subprocess.STDOUT,stdin=subprocess.PIPE)
-        a.wait()
-        qstat = a.communicate()[0]
+        # one query for all clusters
+        counts = backend.query(jobIDs)
         nrunning = 0
-        querylines = [line for line in qstat.split("\n") if "Total for query" in line]
 
-        # check if query matches
-        if len(querylines) == 0:
+        # check if query worked
+        if counts is None:
             errorcount += 1
             # sometimes condor_q is not reachable - if this happens a lot something is probably wrong
-            printer.printWarning("line does not match query")
+            printer.printWarning("job query failed")
             if errorcount == 30:
                 printer.printWarning(
                     "something is off - condor_q has not worked for {} minutes ...".format(
@@ -202,31 +962,24 @@ def monitorJobStatus(jobIDs = None, queryInterval = 60, nTotalJobs = None):
                 time.sleep(120)
             if errorcount == 60:
                 printer.printError("this does not work anymore - removing jobs")
-                command[0] = "condor_rm"
-                printer.printCommand(command)
-                a = subprocess.Popen(command, 
-                    stdout = subprocess.PIPE, stderr = subprocess.STDOUT, stdin = subprocess.PIPE)
+                if jobIDs:
+                    backend.remove(jobIDs)
                 return
             continue
 
         errorcount = 0
         # sum all jobs that are still idle or running
-        jobsRunning = 0
-        jobsIdle        = 0
-        jobsHeld        = 0
-        for line in querylines:
-            jobsRunning += int(re.findall(r'\ [0-9]+\ running', line)[0][1:-8])
-            jobsIdle += int(re.findall(r'\ [0-9]+\ idle', line)[0][1:-5])
-            jobsHeld += int(re.findall(r'\ [0-9]+\ held', line)[0][1:-5])
+        jobsRunning = sum(c["running"] for c in counts.values())
+        jobsIdle    = sum(c["idle"] for c in counts.values())
+        jobsHeld    = sum(c["held"] for c in counts.values())
 
         nrunning += jobsRunning + jobsIdle + jobsHeld
-        printLine = "\033[1;32m{:4d} running\033[0m | \033[1;33m{:4d} idling\033[0m | "
-        printLine+= "\033[1;31m{:4d} held\033[0m |\t \033[1;34mtotal: {:4d}\033[0m"
-        printLine = printLine.format(
-                        jobsRunning, jobsIdle, jobsHeld, nrunning)
-        if not nTotalJobs is None:
-            printLine+= "/\033[1;34m{}\033[0m".format(nTotalJobs)
-        print(printLine)
+        counts = {"running": jobsRunning, "idle": jobsIdle, "held": jobsHeld}
+        printJobCounts(counts, nTotalJobs)
+        stats.record(counts)
+        print(stats.summary())
+        if not statsPath is None:
+            stats.write(statsPath)
 
         if nrunning == 0:
             printer.printAction("waiting on no more jobs - exiting loop")
@@ -316,7 +1069,7 @@ if __name__ == "__main__":
     
     # monitor job status
     if opts.monitorStatus:
-        monitorJobStatus(jobIDs)
+        monitorJobStatus(jobIDs, workdir = workdir)
 
     print("done.")
 
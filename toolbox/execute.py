@@ -4,6 +4,6 @@ def execute(cmd):
     if isinstance(cmd, list):
         cmd = " ".join(cmd)
     printer.printCommand(cmd)
-    os.system(cmd)
+    return os.system(cmd)
 
 
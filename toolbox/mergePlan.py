@@ -0,0 +1,163 @@
+import os
+import json
+import time
+from multiprocessing.pool import ThreadPool
+
+import ROOT
+
+import toolbox.printer as printer
+import toolbox.rutil as rutil
+from toolbox.mkdir import mkdir
+
+class MergePlan:
+    """
+    merge the ntuples and cutflows of many samples in one go
+
+    the inputs of all samples are validated once in a single pass, afterwards
+    the hadd and cutflow merge of every sample are scheduled as independent
+    tasks on a pool of nWorkers threads. each hadd uses chunkWorkers for its
+    chunks, such that at most nWorkers*chunkWorkers merges run at a time.
+    the ROOT work of the tasks (in-process merges, verification) runs in worker
+    processes of rutil, only single tree headers are read in the threads.
+    further keyword arguments are passed to rutil.hadd.
+
+    usage:
+        plan = MergePlan(outputDir, nWorkers = 4)
+        plan.addSample("ttbar", rootFiles, cutflowFiles)
+        plan.run()
+    """
+    def __init__(self, outputDir, treeName = "Events", nWorkers = 4, chunkWorkers = 1, manifest = None, **haddOptions):
+        self.outputDir = outputDir
+        self.treeName = treeName
+        self.nWorkers = nWorkers
+        self.chunkWorkers = chunkWorkers
+        self.manifest = manifest
+        self.haddOptions = haddOptions
+
+        self.samples = []
+        self.report = {}
+
+    def addSample(self, name, files, cutflows = None, target = None, cutflowTarget = None):
+        if target is None:
+            target = os.path.join(self.outputDir, name+".root")
+        if cutflowTarget is None and cutflows:
+            cutflowTarget = os.path.join(self.outputDir, name+"_cutflow.txt")
+        self.samples.append({
+            "name":             name,
+            "files":            list(files),
+            "target":           target,
+            "cutflows":         list(cutflows or []),
+            "cutflowTarget":    cutflowTarget,
+            })
+
+    def _validate(self):
+        """Validate the inputs of all samples in one pass, return the records or None if a file is not ok."""
+        allFiles = []
+        for sample in self.samples:
+            allFiles += sample["files"]
+        if self.treeName is None:
+            return {}
+        records = rutil.validateFiles(allFiles, self.treeName,
+            manifest = self.manifest, nWorkers = self.nWorkers*self.chunkWorkers)
+        ok = True
+        for sample in self.samples:
+            for f in sample["files"]:
+                if not records[f]["status"] == "ok":
+                    printer.printError("input file {} of sample {} is not ok".format(f, sample["name"]))
+                    ok = False
+        if not ok:
+            return None
+        return records
+
+    def _runTask(self, task):
+        """Run a task, errors are recorded in its info instead of ending the whole plan."""
+        kind, sample, _ = task
+        sTime = time.time()
+        try:
+            kind, name, info = self._merge(task)
+        except Exception as e:
+            printer.printError("{} of sample {} failed: {}".format(kind, sample["name"], e))
+            info = {"ok": False, "error": "{}: {}".format(type(e).__name__, e), "exception": e}
+        info["wallTime"] = time.time() - sTime
+        return kind, sample["name"], info
+
+    def _merge(self, task):
+        kind, sample, records = task
+        if kind == "hadd":
+            entries = -1
+            if not self.treeName is None:
+                entries = sum(records[f]["entries"] for f in sample["files"])
+            options = dict(self.haddOptions)
+            options["nWorkers"] = self.chunkWorkers
+            ok = rutil.hadd(sample["files"], sample["target"], entries = entries,
+                treeName = self.treeName, checkInputs = False, **options)
+            info = {
+                "files":        len(sample["files"]),
+                "bytes":        sum(os.path.getsize(f) for f in sample["files"]),
+                "entries":      entries,
+                "outputBytes":  os.path.getsize(sample["target"]) if os.path.exists(sample["target"]) else -1,
+                }
+        else:
+            ok = rutil.mergeCutflow(sample["cutflows"], sample["cutflowTarget"], nWorkers = 1)
+            info = {"files": len(sample["cutflows"])}
+        info["ok"] = ok
+        return kind, sample["name"], info
+
+    def run(self, report = None):
+        """
+        run all merges, return True if all of them succeeded
+
+        the summary is kept in self.report and written as json to report,
+        by default mergeReport.json in the output directory.
+        if a task raised an exception it is recorded in the report and the
+        first one is raised again once the report is written.
+        """
+        sTime = time.time()
+        mkdir(self.outputDir)
+        records = self._validate()
+        if records is None:
+            return False
+
+        tasks = []
+        for sample in self.samples:
+            tasks.append(("hadd", sample, records))
+            if sample["cutflows"]:
+                tasks.append(("cutflow", sample, records))
+
+        # the tasks read tree headers of separate files concurrently
+        ROOT.EnableThreadSafety()
+        pool = ThreadPool(max(1, min(int(self.nWorkers), len(tasks))))
+        try:
+            results = pool.map(self._runTask, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.report = {"samples": {}, "wallTime": time.time() - sTime}
+        errors = []
+        for kind, name, info in results:
+            if "exception" in info:
+                errors.append(info.pop("exception"))
+            self.report["samples"].setdefault(name, {})[kind] = info
+        self.report["ok"] = all(info["ok"] for _, _, info in results)
+
+        if report is None:
+            report = os.path.join(self.outputDir, "mergeReport.json")
+        with open(report, "w") as r:
+            json.dump(self.report, r, indent = 1, sort_keys = True)
+        self.printReport()
+        printer.printInfo("wrote merge report to {}".format(report))
+        if len(errors) > 0:
+            raise errors[0]
+        return self.report["ok"]
+
+    def printReport(self):
+        template = "{:<40} | {:>6} | {:>10} | {:>12} | {:>9} | {:<6}"
+        lines = [template.format("SAMPLE", "FILES", "MB", "ENTRIES", "TIME [s]", "STATUS")]
+        for name in sorted(self.report["samples"]):
+            info = self.report["samples"][name]["hadd"]
+            ok = all(i["ok"] for i in self.report["samples"][name].values())
+            lines.append(template.format(name, info.get("files", "-"), "{:.1f}".format(info["bytes"]/1e6) if "bytes" in info else "-",
+                info.get("entries", "-"), "{:.1f}".format(info["wallTime"]), "OK" if ok else "FAILED"))
+        lines.append("total wall time: {:.1f} s".format(self.report["wallTime"]))
+        printer.printResult("\n".join(lines))
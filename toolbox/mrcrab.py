@@ -2,8 +2,15 @@ import sys
 import os
 import subprocess
 import re
+import csv
+import json
+import sqlite3
 import optparse
 import time
+import signal
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 import toolbox.printer as printer
 
@@ -21,6 +28,41 @@ def setup_crab_query_parser(parser):
                " '--maxjobruntime=2750'"
                " allows multiple calls and overwrites automatically"
                " generated options from --resubmit")
+    parser.add_option("--jobs", "-j",
+        default = 8, dest = "jobs", type = "int",
+        help = "number of crab projects queried at the same time")
+    parser.add_option("--timeout",
+        default = 300, dest = "timeout", type = "int",
+        help = "seconds after which the query of a single project is given up")
+    parser.add_option("--cache",
+        default = os.path.expanduser("~/.cache/mrcrab/status.json"), dest = "cache",
+        help = "file caching the status of the projects, completed projects"
+               " are never queried again")
+    parser.add_option("--cache-ttl",
+        default = 900, dest = "cache_ttl", type = "int",
+        help = "seconds for which the cached status of a running project is used"
+               " instead of querying it again (ignored with --resubmit)")
+    parser.add_option("--no-cache",
+        default = False, dest = "no_cache", action = "store_true",
+        help = "query all projects and do not update the cache")
+    parser.add_option("--watch",
+        default = None, dest = "watch", type = "int", metavar = "SECONDS",
+        help = "query all projects every SECONDS and resubmit failed jobs according"
+               " to the resubmission policy until all projects are completed")
+    parser.add_option("--policy",
+        default = None, dest = "policy",
+        help = "json file with the resubmission policy, see ResubmitPolicy")
+    parser.add_option("--history",
+        default = os.path.expanduser("~/.cache/mrcrab/history.json"), dest = "history",
+        help = "file keeping the resubmissions and status changes of every project")
+    parser.add_option("--export",
+        dest = "export", action = "append", default = [],
+        help = "write the summary of all projects to a .json or .csv file,"
+               " allows multiple calls")
+    parser.add_option("--db",
+        default = None, dest = "db",
+        help = "sqlite database collecting a snapshot of the queried projects on every call,"
+               " e.g. ~/.cache/mrcrab/history.sqlite")
 
     return parser
 
@@ -48,6 +90,16 @@ def printcolor(cmd, groupname):
     return cmd
 
 
+statusColors = {
+    "COMPLETED":    printgreen,
+    "SUBMITTED":    printblue,
+    "KILLED":       printred,
+    "NEW":          printyellow,
+    "QUEUED":       printyellow,
+    "FAILED":       printred,
+    "TIMEOUT":      printred,
+    }
+
 def checkOptions(options, key):
     foundKey = False
     for opt in options:
@@ -55,10 +107,156 @@ def checkOptions(options, key):
             foundKey = True
     return foundKey
 
+class CrabStatus:
+    '''
+    status of a crab project, parsed in a single pass over the output of crab status
+
+    server_status:      status on the crab server, e.g. 'SUBMITTED' or 'NEW on command SUBMIT'
+    scheduler_status:   status on the scheduler, e.g. 'COMPLETED'
+    jobs:               job state -> number of jobs, njobs is the total number of jobs
+    publication:        publication state -> number of files, npublication the total
+    errors:             exit code -> number of jobs failed with it
+    unknown_errors:     number of failed jobs without exit code
+    '''
+    groupRegex   = re.compile(r"([a-zA-Z]+)\s+[0-9.]+\s*%\s*\(\s*([0-9]+)\s*/\s*([0-9]+)\s*\)")
+    errorRegex   = re.compile(r"([0-9]+) jobs failed with exit code (-?[0-9]+)")
+    unknownRegex = re.compile(r"Could not find exit code details for ([0-9]+) jobs")
+
+    def __init__(self, output = ""):
+        self.server_status = ""
+        self.scheduler_status = ""
+        self.task_name = ""
+        self.jobs = {}
+        self.njobs = -1
+        self.publication = {}
+        self.npublication = -1
+        self.errors = {}
+        self.unknown_errors = 0
+        self.parse(output)
+
+    def parse(self, output):
+        section = None
+        for line in output.splitlines():
+            stripped = line.strip()
+            # the job and publication states are continued on indented lines
+            if stripped.startswith("Jobs status"):
+                section = "jobs"
+            elif stripped.startswith("Publication status"):
+                section = "publication"
+            elif stripped.startswith("Error Summary"):
+                section = "errors"
+            elif stripped == "" or not line[0].isspace():
+                if section in ["jobs", "publication"]:
+                    section = None
+
+            if section in ["jobs", "publication"]:
+                for state, n, total in self.groupRegex.findall(line):
+                    self.add_group(section, state, int(n), int(total))
+                continue
+            if section == "errors":
+                match = self.errorRegex.search(line)
+                if not match is None:
+                    self.errors[int(match.group(2))] = int(match.group(1))
+                match = self.unknownRegex.search(line)
+                if not match is None:
+                    self.unknown_errors = int(match.group(1))
+                continue
+
+            if ":" in line:
+                key, value = line.split(":", 1)
+                key = key.strip()
+                if key == "Status on the CRAB server":
+                    self.server_status = value.strip()
+                elif key == "Status on the scheduler":
+                    self.scheduler_status = value.strip()
+                elif key == "Task name":
+                    self.task_name = value.strip()
+
+    def add_group(self, section, state, n, total):
+        if section == "jobs":
+            self.jobs[state] = n
+            if self.njobs == -1:
+                self.njobs = total
+            elif not self.njobs == total:
+                raise ValueError("number of jobs doesnt match in state {}".format(state))
+        else:
+            self.publication[state] = n
+            self.npublication = total
+
+class ResubmitPolicy:
+    '''
+    options of crab resubmit depending on the exit codes of the failed jobs
+
+    rules is a dictionary exit code -> rule with the keys
+        option:     crab resubmit option, e.g. 'maxmemory'
+        start:      value of the option at the first resubmission for the exit code
+        factor:     the value grows by factor with every further resubmission
+        max:        the value never exceeds max
+        retries:    optional number of resubmissions for the exit code
+        reason:     optional explanation printed along
+    a project is resubmitted at most maxRetries times in total.
+
+    policy files are json with the keys 'maxRetries' and 'rules', e.g.
+        {"maxRetries": 5, "rules": {"50660": {"option": "maxmemory", "start": 3000,
+            "factor": 1.5, "max": 6000, "retries": 3}}}
+    '''
+    defaultRules = {
+        50660: {"option": "maxmemory", "start": 4000, "factor": 1.25, "max": 5000,
+                "reason": "Application terminated by wrapper because using too much RAM (RSS)"},
+        50664: {"option": "maxjobruntime", "start": 2750, "factor": 1., "max": 2750,
+                "reason": "Application terminated by wrapper because using too much Wall Clock time"},
+        }
+
+    def __init__(self, rules = None, maxRetries = 10):
+        if rules is None:
+            rules = self.defaultRules
+        self.rules = dict((int(code), rule) for code, rule in rules.items())
+        self.maxRetries = maxRetries
+
+    def value(self, rule, n):
+        # value of the option at the n-th resubmission for the exit code of rule
+        value = min(rule["start"]*rule.get("factor", 1.)**(n-1), rule.get("max", rule["start"]))
+        return int(value)
+
+    def options(self, errors, history, additional_options):
+        '''
+        resubmit options for the errors (exit code -> number of jobs) of a project with
+        history, options in additional_options take precedence.
+        returns None if the project must not be resubmitted anymore
+        '''
+        if history["resubmissions"] >= self.maxRetries:
+            printer.printError("\tproject was already resubmitted {} times - giving up".format(
+                history["resubmissions"]))
+            return None
+
+        options = list(additional_options)
+        for exitcode, failedjobs in sorted(errors.items()):
+            print(printred("\texitcode: {:<7} | {:<5} jobs".format(exitcode, failedjobs)))
+            if not exitcode in self.rules:
+                continue
+            rule = self.rules[exitcode]
+            if "reason" in rule:
+                printer.printInfo("\t"+rule["reason"])
+            n = history["exitcodes"].get(str(exitcode), 0)+1
+            if "retries" in rule and n > rule["retries"]:
+                printer.printError("\tjobs failed with exit code {} already {} times - giving up".format(
+                    exitcode, n-1))
+                return None
+            if not checkOptions(options, rule["option"]):
+                options.append("--{}={}".format(rule["option"], self.value(rule, n)))
+        return options
+
+def load_resubmit_policy(path):
+    if path is None:
+        return ResubmitPolicy()
+    with open(path, "r") as f:
+        policy = json.load(f)
+    return ResubmitPolicy(policy.get("rules"), policy.get("maxRetries", 10))
+
+def new_history():
+    return {"resubmissions": 0, "exitcodes": {}, "events": []}
+
 class CrabResult:
-    __statusRegex    = r"[a-zA-Z]+ [0-9]+\.[0-9]\% \(\s*[0-9]+/[0-9]+\)"
-    __jobNumberRegex = r"\( *([0-9]+)\/ *([0-9]+)\)"
-    __errorRegex     = r"[0-9]+ jobs failed with exit code [0-9]+"
     def __init__(self, project_dir):
         self.path = project_dir
         self.name = os.path.basename(self.path)
@@ -69,213 +267,196 @@ class CrabResult:
 
         self.njobs = -1
         self.detected_groups = {}
-
-    def query(self):
-        # build crab command
-        command = ["crab", "status", self.path]
-        
+        self.cached = None
+        self.resubmitted = None
+        # set if failed jobs or publications are left that the policy does not resubmit anymore
+        self.given_up = False
+        self.record = CrabStatus()
+
+    def run_crab(self, command, timeout = None):
+        # run crab command, returns None if it was killed after timeout seconds
+        # crab runs in its own session such that its whole process group can be killed,
+        # preexec_fn is not safe in threads and only used on python 2
+        if sys.version_info[0] >= 3:
+            session = {"start_new_session": True}
+        else:
+            session = {"preexec_fn": os.setsid}
         process = subprocess.Popen(command, 
             stdout = subprocess.PIPE, 
             stderr = subprocess.STDOUT, 
-            stdin  = subprocess.PIPE)
-
-        process.stdin.write("\n")
-        process.wait()
-        self.query = process.communicate()[0]
-        if "Enter GRID pass phrase" in self.query:
+            stdin  = subprocess.PIPE,
+            universal_newlines = True,
+            **session)
+
+        expired = []
+        def kill():
+            # kill the whole process group, children of crab keep the output pipe open
+            expired.append(True)
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, kill)
+            timer.start()
+        try:
+            output = process.communicate("\n")[0]
+        finally:
+            if not timer is None:
+                timer.cancel()
+        if expired:
+            return None
+        return output
+
+    def set_timeout(self, timeout):
+        printer.printWarning("query of project {} timed out after {} s".format(self.name, timeout))
+        self.status = "TIMEOUT"
+        self.status_str = printred("TIMEOUT")
+
+    def query(self, timeout = None):
+        # build crab command
+        command = ["crab", "status", self.path]
+        
+        output = self.run_crab(command, timeout)
+        if output is None:
+            self.set_timeout(timeout)
+            return False
+        if "Enter GRID pass phrase" in output:
             printer.printError("need to init voms proxy")
             sys.exit()
-        
-        self.query = self.query.replace("\t"," ")
-        self.query = self.query.replace("\n"," ")
-        while "  " in self.query:
-            self.query = self.query.replace("  "," ")
-            
+
+        self.output = output
+        try:
+            self.record = CrabStatus(output)
+        except ValueError as e:
+            printer.printError("ERROR: {} for project {}".format(e, self.name))
+            self.record = CrabStatus()
         return True
 
     def query_crab_report(self):
         # build crab command
         command = ["crab", "report", self.path]
         
-        process = subprocess.Popen(command, 
-            stdout = subprocess.PIPE, 
-            stderr = subprocess.STDOUT, 
-            stdin  = subprocess.PIPE)
-
-        process.stdin.write("\n")
-        process.wait()
-        self.query = process.communicate()[0]
-        if "Enter GRID pass phrase" in self.query:
+        output = self.run_crab(command)
+        if "Enter GRID pass phrase" in output:
             printer.printError("need to init voms proxy")
             sys.exit()
-        
-        self.query = self.query.replace("\t"," ")
-        self.query = self.query.replace("\n"," ")
-        while "  " in self.query:
-            self.query = self.query.replace("  "," ")
-            
+
+        # report output with collapsed whitespace
+        self.query = " ".join(output.split())
         return True
 
+    def set_status(self, status):
+        self.status = status
+        self.status_str = statusColors.get(status, printred)(status)
+
     def get_status(self):
-        if "Status on the scheduler: COMPLETED" in self.query:
-            self.status = "COMPLETED"
-            self.status_str = printgreen("COMPLETED")
-        elif "Status on the CRAB server: SUBMITTED" in self.query:
-            self.status = "SUBMITTED"
-            self.status_str = printblue("SUBMITTED")
-        elif "Status on the CRAB server: KILLED" in self.query:
-            self.status = "KILLED"
-            self.status_str = printred("KILLED")
-        elif "Status on the CRAB server: NEW on command SUBMIT" in self.query:
-            self.status = "NEW"
-            self.status_str = printyellow("NEW")
-        elif "Status on the CRAB server: QUEUED on command SUBMIT" in self.query:
-            self.status = "QUEUED"
-            self.status_str = printyellow("QUEUED")
+        server = self.record.server_status.split(" ")[0]
+        if self.record.scheduler_status == "COMPLETED":
+            self.set_status("COMPLETED")
+        elif server in ["SUBMITTED", "KILLED"]:
+            self.set_status(server)
+        elif server in ["NEW", "QUEUED"] and self.record.server_status.endswith("on command SUBMIT"):
+            self.set_status(server)
         else:
-            self.status = "FAILED"
-            self.status_str = printred("FAILED")
+            self.set_status("FAILED")
             return False
 
         return True
 
     def get_jobstatus(self):
-        # look for entries of job status
+        # job states are parsed by CrabStatus, e.g.
         # Jobs status: idle 46.9% ( 68/145) running 35.9% ( 52/145) unsubmitted 17.2% ( 25/145)
-        jobstatus = self.query.split("Jobs status: ")
-        if not len(jobstatus) == 2:
-            return False
-
-        jobstatus = jobstatus[1].split("Publication status")[0]
-        self.groups = re.findall(self.__statusRegex, jobstatus)
-        return True
+        return len(self.record.jobs) > 0
 
     def get_pubstatus(self):
-        self.pubgroups = []
-        pubstatus = self.query.split("Publication status")
-        if len(pubstatus) == 2:
-            self.pubgroups = re.findall(self.__statusRegex, pubstatus[1])
         return True
 
     def collect_groups(self):
-        # loop over all groups
-        for group in self.groups+self.pubgroups:
-            # get name of group
-            groupname = group.split(" ")[0]
-
-            # check if it is a pub group
-            if not group in self.groups:
-                groupname = "pub "+groupname
-
+        self.njobs = self.record.njobs
+        for state, n in self.record.jobs.items():
             # identify tail jobs
-            if groupname == "jobs":
-                groupname = "tail jobs"
-
-            # identify total job number and done job number
-            match = re.search(self.__jobNumberRegex, group)
-            if match is None:
-                printer.printError("group {} could not be parsed".format(group))
-                return False
-            finishedjobs = int(match.group(1))
-            totaljobs    = int(match.group(2))
-
-            # check if number of total jobs matches with previous groups
-            if self.njobs == -1:
-                self.njobs = totaljobs
-            else:
-                if not self.njobs == totaljobs:
-                    # printer.printError("{}, {}".format(info["njobs"], totaljobs))
-                    printer.printError(
-                        "ERROR: number of jobs doesnt match for project {}".format(self.name))
-                    return False
-
-
-            # save information of detected groups
-            self.detected_groups[groupname] = finishedjobs
-
+            if state == "jobs":
+                state = "tail jobs"
+            self.detected_groups[state] = n
+        for state, n in self.record.publication.items():
+            self.detected_groups["pub "+state] = n
         return True
 
-    def resubmit(self, additional_options):
+    def resubmit(self, additional_options, policy = None, history = None, timeout = None):
+        '''
+        resubmit failed jobs with the options of policy (see ResubmitPolicy) for the
+        project history, which is updated. returns the resubmit command or None.
+        crab is killed after timeout seconds, like in query
+        '''
+        if policy is None:
+            policy = ResubmitPolicy()
+        if history is None:
+            history = new_history()
 
         # check if some jobs failed
         if "failed" in self.detected_groups:
             printer.printBreak(1)
             printer.printDelim("=",30)
             
-            # collect error log
-            errorlog = self.query.split("Error Summary: ")
-            if len(errorlog) == 2:  errorlog = errorlog[1]
-            else:                   errorlog = None
-
-            # resubmit options
-            resubmit_options = additional_options
-
             printer.printInfo("found failed jobs: {}".format(
                 self.detected_groups["failed"]))
 
-            # search error log for more specific information
-            if not errorlog is None:
-                # find all errors
-                errors = re.findall(self.__errorRegex, errorlog)
-
-                for error in errors:
-                    error = error.split(" jobs failed with exit code ")
-                    failedjobs = int(error[0])
-                    exitcode   = int(error[1])
-
-                    print(printred("\texitcode: {:<7} | {:<5} jobs".format(exitcode, failedjobs)))
-
-                    if exitcode == 50660:
-                        printer.printInfo(
-                            "\tApplication terminated by wrapper because using too much RAM (RSS)")
-                        if not checkOptions(resubmit_options, "maxmemory"):
-                            resubmit_options.append("--maxmemory=4000")
-                    if exitcode == 50664:
-                        printer.printInfo(
-                            "\tApplication terminated by wrapper because using too much Wall Clock time")
-                        if not checkOptions(resubmit_options, "maxjobruntime"):
-                            resubmit_options.append("--maxjobruntime=2750")
+            # resubmit options from the error summary
+            resubmit_options = policy.options(self.record.errors, history, additional_options)
+            if resubmit_options is None:
+                self.given_up = True
+                printer.printDelim("=",30)
+                return None
 
             # builindg command for resubmitting
             printer.printAction("building resubmit command...")
             resub_command = ["crab", "resubmit"]+resubmit_options+[self.path]
 
-            # resubmit command
-            printer.printCommand(" ".join(resub_command))
-            process = subprocess.Popen(resub_command, 
-                stdout = subprocess.PIPE, 
-                stderr = subprocess.STDOUT, 
-                stdin  = subprocess.PIPE)
-            process.wait()
-            output = process.communicate()[0]
-
-            # resubmit result
-            printer.printResult(output)
-            printer.printDelim("=",30)
-            printer.printBreak(1)
+            for exitcode in self.record.errors:
+                if exitcode in policy.rules:
+                    history["exitcodes"][str(exitcode)] = history["exitcodes"].get(str(exitcode), 0)+1
+            return self.run_resubmit(resub_command, history, timeout)
 
         elif "pub failed" in self.detected_groups:
             printer.printBreak(1)
             printer.printDelim("=",30)
             printer.printInfo("failed publication for some jobs")
 
+            # publication resubmissions count towards the retries of the policy as well
+            if history["resubmissions"] >= policy.maxRetries:
+                printer.printError("\tproject was already resubmitted {} times - giving up".format(
+                    history["resubmissions"]))
+                self.given_up = True
+                printer.printDelim("=",30)
+                return None
+
             # building command for resubmitting
             printer.printAction("building resubmit command ...")
             resub_command = ["crab", "resubmit", "--publication", self.path]
-
-            printer.printCommand(" ".join(resub_command))
-            process = subprocess.Popen(resub_command, 
-                stdout = subprocess.PIPE, 
-                stderr = subprocess.STDOUT, 
-                stdin  = subprocess.PIPE)
-            process.wait()
-            output = process.communicate()[0]
-
-            # resubmit result
+            return self.run_resubmit(resub_command, history, timeout)
+        return None
+
+    def run_resubmit(self, resub_command, history, timeout = None):
+        # the resubmission is recorded before crab is called, if crab_query_all gives up
+        # on the query while crab is still running it stays in the history as pending
+        history["resubmissions"] += 1
+        history["pending"] = " ".join(resub_command)
+
+        printer.printCommand(" ".join(resub_command))
+        output = self.run_crab(resub_command, timeout)
+
+        # resubmit result
+        if output is None:
+            printer.printWarning("resubmission of {} timed out after {} s - it may have gone through nevertheless".format(
+                self.name, timeout))
+        else:
             printer.printResult(output)
-            printer.printDelim("=",30)
-            printer.printBreak(1)
-
+        history.pop("pending", None)
+        printer.printDelim("=",30)
+        printer.printBreak(1)
+        return resub_command
 
     def get_status_list(self, groups):
         status = []
@@ -301,6 +482,35 @@ class CrabResult:
                 status.append(printcolor("", entry))
         return status
 
+    def is_final(self):
+        # completed with all jobs finished and everything published
+        if not self.status == "COMPLETED" or self.njobs == -1:
+            return False
+        if not self.detected_groups.get("finished", 0) == self.njobs:
+            return False
+        for group in self.detected_groups:
+            if group.startswith("pub ") and not group == "pub done":
+                return False
+        return True
+
+    def to_cache(self):
+        return {
+            "time":     time.time(),
+            "status":   self.status,
+            "njobs":    self.njobs,
+            "groups":   dict(self.detected_groups),
+            "errors":   dict((str(code), n) for code, n in self.record.errors.items()),
+            "final":    self.is_final(),
+            }
+
+    def from_cache(self, entry):
+        self.status = entry["status"]
+        self.status_str = statusColors.get(self.status, printred)(self.status)
+        self.njobs = entry["njobs"]
+        self.detected_groups = dict(entry["groups"])
+        self.record.errors = dict((int(code), n) for code, n in entry.get("errors", {}).items())
+        self.cached = entry["time"]
+
     def get_njobs(self, entry):
         if entry == "totaljobs":
             if self.njobs == -1:
@@ -316,12 +526,13 @@ class CrabResult:
 
 
 # function to collect crab query
-def crab_query(project, opts):
+def crab_query(project, opts, policy = None, history = None):
     # initialize crab result class
     res = CrabResult(project)
 
     # perform crab query
-    res.query()
+    if not res.query(getattr(opts, "timeout", None)):
+        return res
     
     # query status and return if failed
     if not res.get_status():
@@ -339,10 +550,176 @@ def crab_query(project, opts):
 
     # potential immediate resubmit
     if opts.do_resubmit:
-        res.resubmit(opts.additional_options)   
+        res.resubmitted = res.resubmit(opts.additional_options, policy, history, getattr(opts, "timeout", None))
     
     return res
     
+def crab_query_job(args):
+    # sys.exit of a query (e.g. missing proxy) is passed on to the main thread
+    try:
+        return crab_query(*args)
+    except SystemExit as e:
+        return e
+
+# function to collect the crab queries of many projects
+def load_json_file(path):
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except ValueError:
+        printer.printWarning("could not read {} - ignoring it".format(path))
+        return {}
+
+def write_json_file(path, data):
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    # write to a temporary file first, such that concurrent mrcrab calls never read half a file
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent = 1, sort_keys = True)
+    os.rename(tmp, path)
+
+def cached_crab_result(project, entry, opts):
+    # cached result of the project if it does not need to be queried again
+    if entry is None:
+        return None
+    res = CrabResult(project)
+    res.from_cache(entry)
+    # decided from the cached groups, entries written by older versions may be marked final wrongly
+    if not res.is_final():
+        if getattr(opts, "do_resubmit", False):
+            return None
+        if time.time() - entry["time"] > getattr(opts, "cache_ttl", 900):
+            return None
+    return res
+
+def add_history_event(history, res, maxEvents = 500):
+    # keep status changes and resubmissions of the project,
+    # including a resubmission still pending in a query that was given up
+    pending = history.pop("pending", None)
+    event = {
+        "time":         time.time(),
+        "status":       res.status,
+        "groups":       dict(res.detected_groups),
+        "resubmit":     pending if res.resubmitted is None else " ".join(res.resubmitted),
+        }
+    last = history["events"][-1] if history["events"] else {}
+    if event["resubmit"] is None and last.get("status") == event["status"] and last.get("groups") == event["groups"]:
+        return
+    history["events"] = (history["events"]+[event])[-maxEvents:]
+
+def crab_query_all(projects, opts, history = None):
+    '''
+    query the projects concurrently on opts.jobs threads, each query is given up
+    after opts.timeout seconds. returns the results in the order of projects
+
+    the status of the projects is cached in opts.cache, completed projects are
+    never queried again and others only after opts.cache_ttl seconds.
+    failed jobs are resubmitted with opts.do_resubmit following the policy in
+    opts.policy, resubmissions and status changes are kept in opts.history
+    (or in history, a dictionary project directory -> history kept by the caller)
+    '''
+    cachePath = None
+    if not getattr(opts, "no_cache", True):
+        cachePath = getattr(opts, "cache", None)
+    cache = load_json_file(cachePath)
+    policy = load_resubmit_policy(getattr(opts, "policy", None))
+    historyPath = getattr(opts, "history", None)
+    if history is None:
+        history = load_json_file(historyPath)
+
+    results = {}
+    for project in projects:
+        res = cached_crab_result(project, cache.get(os.path.abspath(project)), opts)
+        if not res is None:
+            results[project] = res
+    toQuery = [project for project in projects if not project in results]
+
+    njobs = max(1, min(int(getattr(opts, "jobs", 8)), len(toQuery)))
+    timeout = getattr(opts, "timeout", None)
+    printer.printAction("querying {} projects with {} threads ({} cached)".format(
+        len(toQuery), njobs, len(results)))
+
+    pool = ThreadPool(njobs)
+    asyncResults = []
+    for project in toQuery:
+        entry = history.setdefault(os.path.abspath(project), new_history())
+        asyncResults.append(pool.apply_async(crab_query_job, ((project, opts, policy, entry),)))
+    pool.close()
+
+    sTime = time.time()
+    for project, asyncResult in zip(toQuery, asyncResults):
+        # the projects are queried in parallel, the deadline of the last one
+        # is at most njobs rounds of timeouts away (two with the resubmission)
+        wait = None
+        if timeout:
+            perProject = timeout*(2 if getattr(opts, "do_resubmit", False) else 1)
+            deadline = sTime + perProject*(len(toQuery)//njobs+1) + 30
+            wait = max(deadline - time.time(), 1)
+        try:
+            res = asyncResult.get(wait)
+        except multiprocessing.TimeoutError:
+            res = CrabResult(project)
+            res.set_timeout(timeout)
+        if isinstance(res, SystemExit):
+            pool.terminate()
+            raise res
+        results[project] = res
+        if not res.status in ["FAILED", "TIMEOUT"]:
+            cache[os.path.abspath(project)] = res.to_cache()
+        add_history_event(history[os.path.abspath(project)], res)
+    pool.terminate()
+
+    if historyPath:
+        write_json_file(historyPath, history)
+    if not cachePath is None:
+        write_json_file(cachePath, cache)
+    return [results[project] for project in projects]
+
+def crab_watch(projects, opts, maxFailedChecks = 3):
+    '''
+    query the open projects every opts.watch seconds and resubmit their failed jobs,
+    until all projects are completed, killed or given up. projects are given up if the
+    resubmission policy does not resubmit them anymore, or if their status could not be
+    queried (FAILED or TIMEOUT) in maxFailedChecks checks in a row.
+    returns the last results of all projects
+    '''
+    opts.do_resubmit = True
+    # the resubmissions are counted across the checks, also without opts.history
+    history = load_json_file(getattr(opts, "history", None))
+    results = {}
+    failedChecks = dict((project, 0) for project in projects)
+    open_projects = list(projects)
+    while True:
+        printer.printInfo("checking {} projects at {}".format(len(open_projects), time.strftime("%Y-%m-%d %H:%M:%S")), 1)
+        checked = crab_query_all(open_projects, opts, history)
+        results.update(zip(open_projects, checked))
+        print_crab_summary([results[project] for project in projects])
+        save_crab_summary(checked, opts)
+
+        still_open = []
+        for project, res in zip(open_projects, checked):
+            if res.status in ["FAILED", "TIMEOUT"]:
+                failedChecks[project] += 1
+                if failedChecks[project] >= maxFailedChecks:
+                    printer.printError("status of {} could not be queried in {} checks - giving up".format(
+                        res.name, failedChecks[project]))
+                    res.given_up = True
+            else:
+                failedChecks[project] = 0
+            # finished as far as the projects go, or nothing more mrcrab can do for them
+            if not (res.is_final() or res.status == "KILLED" or res.given_up):
+                still_open.append(project)
+        open_projects = still_open
+        if len(open_projects) == 0:
+            printer.printInfo("all projects are completed or given up - exiting watch mode")
+            return [results[project] for project in projects]
+        printer.printAction("{} projects still open, next check in {} s".format(len(open_projects), opts.watch))
+        time.sleep(opts.watch)
+
 # function to create crab report
 def crab_report(project, opts):
     # initialize crab result class
@@ -414,3 +791,142 @@ def print_crab_summary(results):
     output_lines.append(template.format(*percentStatus))
 
     print("\n".join(output_lines))
+
+
+def crab_summary(results):
+    '''
+    summary of the results as dictionary with the time, one entry per project
+    and the total number of jobs per status group
+    '''
+    allGroups = sorted(set(g for res in results for g in res.detected_groups))
+    summary = {"time": time.time(), "projects": [], "total": {}}
+    for res in results:
+        summary["projects"].append({
+            "name":     res.name,
+            "path":     os.path.abspath(res.path),
+            "status":   getattr(res, "status", "FAILED"),
+            "njobs":    res.get_njobs("totaljobs"),
+            "groups":   dict((g, res.get_njobs(g)) for g in allGroups),
+            "cached":   res.cached,
+            })
+    for entry in ["totaljobs"]+allGroups:
+        summary["total"][entry] = sum(res.get_njobs(entry) for res in results)
+    return summary
+
+def export_crab_summary(summary, path):
+    # write the summary as json or, for any other extension, as csv with one line per project
+    if path.endswith(".json"):
+        with open(path, "w") as f:
+            json.dump(summary, f, indent = 1, sort_keys = True)
+        return
+    groups = sorted(summary["total"])
+    groups.remove("totaljobs")
+    with open(path, "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(["name", "status", "totaljobs"]+groups)
+        for project in summary["projects"]:
+            writer.writerow([project["name"], project["status"], project["njobs"]]+
+                [project["groups"][g] for g in groups])
+        writer.writerow(["TOTAL", "", summary["total"]["totaljobs"]]+
+            [summary["total"][g] for g in groups])
+
+def record_crab_snapshot(summary, dbpath):
+    '''
+    add the summary as snapshot to the sqlite database dbpath with the tables
+        snapshots(id, time)
+        projects(snapshot, name, path, status, njobs, cached)
+        job_groups(snapshot, path, state, njobs)
+    only projects queried for the summary are recorded, results from the cache
+    and failed queries would add stale points. returns the snapshot id or None
+    '''
+    projects = [project for project in summary["projects"]
+        if project["cached"] is None and not project["status"] in ["FAILED", "TIMEOUT"]]
+    if len(projects) == 0:
+        return None
+    directory = os.path.dirname(os.path.abspath(dbpath))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    db = sqlite3.connect(dbpath, timeout = 60)
+    try:
+        db.execute("CREATE TABLE IF NOT EXISTS snapshots (id INTEGER PRIMARY KEY AUTOINCREMENT, time REAL)")
+        db.execute("CREATE TABLE IF NOT EXISTS projects (snapshot INTEGER, name TEXT, path TEXT,"
+            " status TEXT, njobs INTEGER, cached REAL)")
+        db.execute("CREATE TABLE IF NOT EXISTS job_groups (snapshot INTEGER, path TEXT, state TEXT, njobs INTEGER)")
+        db.execute("CREATE INDEX IF NOT EXISTS projects_path ON projects (path, snapshot)")
+        db.execute("CREATE INDEX IF NOT EXISTS job_groups_state ON job_groups (snapshot, path, state)")
+        db.execute("CREATE INDEX IF NOT EXISTS snapshots_time ON snapshots (time)")
+        snapshot = db.execute("INSERT INTO snapshots (time) VALUES (?)", (summary["time"],)).lastrowid
+        for project in projects:
+            db.execute("INSERT INTO projects VALUES (?, ?, ?, ?, ?, ?)", (snapshot, project["name"],
+                project["path"], project["status"], project["njobs"], project["cached"]))
+            db.executemany("INSERT INTO job_groups VALUES (?, ?, ?, ?)",
+                [(snapshot, project["path"], state, n) for state, n in sorted(project["groups"].items())])
+        db.commit()
+    finally:
+        db.close()
+    return snapshot
+
+def crab_progress(dbpath, project = None, state = "finished", since = None):
+    '''
+    list of (time, jobs in state, total jobs) of all snapshots in dbpath (taken after since),
+    summed over the projects recorded in each snapshot or for the project directory project
+    '''
+    query = ("SELECT s.time, SUM(COALESCE(g.njobs, 0)), SUM(p.njobs) FROM snapshots s"
+        " JOIN projects p ON p.snapshot = s.id"
+        " LEFT JOIN job_groups g ON g.snapshot = s.id AND g.path = p.path AND g.state = ?"
+        " WHERE s.time >= ?")
+    args = [state, since or 0.]
+    if not project is None:
+        query += " AND p.path = ?"
+        args.append(os.path.abspath(project))
+    query += " GROUP BY s.id ORDER BY s.time"
+    db = sqlite3.connect(dbpath, timeout = 60)
+    try:
+        return db.execute(query, args).fetchall()
+    finally:
+        db.close()
+
+def crab_completion_rate(dbpath, project = None, hours = 24):
+    # finished jobs per hour over the snapshots of the last hours
+    progress = crab_progress(dbpath, project, since = time.time() - hours*3600)
+    if len(progress) < 2 or progress[-1][0] == progress[0][0]:
+        return 0.
+    return 3600.*(progress[-1][1] - progress[0][1])/(progress[-1][0] - progress[0][0])
+
+def crab_completion_rates(dbpath, hours = 24, state = "finished"):
+    '''
+    dictionary project directory -> jobs per hour reaching state, between the first
+    and the last snapshot of the project in the last hours (a single query for all projects)
+    '''
+    query = ("SELECT b.path, b.first, b.last,"
+        " SUM(CASE WHEN s.time = b.first THEN COALESCE(g.njobs, 0) ELSE 0 END),"
+        " SUM(CASE WHEN s.time = b.last THEN COALESCE(g.njobs, 0) ELSE 0 END)"
+        " FROM (SELECT p.path AS path, MIN(s.time) AS first, MAX(s.time) AS last FROM snapshots s"
+        "   JOIN projects p ON p.snapshot = s.id WHERE s.time >= ? GROUP BY p.path) b"
+        " JOIN projects p ON p.path = b.path"
+        " JOIN snapshots s ON s.id = p.snapshot AND s.time IN (b.first, b.last)"
+        " LEFT JOIN job_groups g ON g.snapshot = p.snapshot AND g.path = p.path AND g.state = ?"
+        " GROUP BY b.path")
+    db = sqlite3.connect(dbpath, timeout = 60)
+    try:
+        rows = db.execute(query, (time.time() - hours*3600, state)).fetchall()
+    finally:
+        db.close()
+    rates = {}
+    for path, first, last, nfirst, nlast in rows:
+        rates[path] = 0. if last == first else 3600.*(nlast - nfirst)/(last - first)
+    return rates
+
+def save_crab_summary(results, opts):
+    # export the summary to the files in opts.export and add a snapshot to opts.db
+    summary = crab_summary(results)
+    for path in getattr(opts, "export", []):
+        export_crab_summary(summary, path)
+        printer.printInfo("wrote crab summary to {}".format(path))
+    dbpath = getattr(opts, "db", None)
+    if dbpath:
+        record_crab_snapshot(summary, dbpath)
+        rates = crab_completion_rates(dbpath)
+        rate = sum(rates.get(project["path"], 0.) for project in summary["projects"])
+        if rate > 0:
+            printer.printInfo("{:.1f} jobs finished per hour over the last day".format(rate))
@@ -1,77 +1,531 @@
 import ROOT
 import re 
 import os
+import csv
+import json
+import math
+import time
+import heapq
+import stat
+import resource
+import threading
+from collections import OrderedDict
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 import toolbox.printer as printer
 from toolbox.execute import execute 
+from toolbox.mkdir import mkdir
+from toolbox.condorSubmit import submitToBatch, monitorJobStatus, cmsswSetupTemplate
 
 def chunks(l, n):
     """Yield successive n-sized chunks from l."""
     for i in range(0, len(l), n):
         yield l[i:i + n]
 
+def openFileLimit(reserve = 64):
+    """Number of files a single merge process may keep open within the soft RLIMIT_NOFILE."""
+    soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if soft == resource.RLIM_INFINITY:
+        return None
+    return max(int(soft) - int(reserve), 2)
+
+def planChunks(files, chunkSize = 500, weights = None, maxWeight = None, maxOpenFiles = None, maxMemory = None, memoryPerFile = 10.):
+    """
+    split files into chunks of about equal total weight
+
+    weights is a dictionary path -> weight (e.g. bytes or entries), by default
+    the file sizes are used. the number of chunks is chosen such that no chunk
+    has more than chunkSize files (further limited by maxOpenFiles and by
+    maxMemory/memoryPerFile, both in MB) and, if maxWeight is given, that the
+    chunks do not exceed maxWeight on average.
+    files are assigned largest first to the currently lightest chunk, within a
+    chunk the original order of the files is kept.
+    """
+    files = list(files)
+    if len(files) == 0:
+        return []
+    if weights is None:
+        weights = dict((f, os.path.getsize(f)) for f in files)
+
+    maxFiles = int(chunkSize)
+    if not maxOpenFiles is None:
+        maxFiles = min(maxFiles, int(maxOpenFiles))
+    if not maxMemory is None:
+        maxFiles = min(maxFiles, int(float(maxMemory)/float(memoryPerFile)))
+    maxFiles = max(maxFiles, 1)
+
+    nChunks = int(math.ceil(len(files)/float(maxFiles)))
+    if not maxWeight is None:
+        total = sum(weights[f] for f in files)
+        nChunks = max(nChunks, int(math.ceil(total/float(maxWeight))))
+    nChunks = min(nChunks, len(files))
+
+    order = dict((f, i) for i, f in enumerate(files))
+    plan = [[] for _ in range(nChunks)]
+    heap = [(0, i) for i in range(nChunks)]
+    for f in sorted(files, key = lambda f: weights[f], reverse = True):
+        load, i = heapq.heappop(heap)
+        plan[i].append(f)
+        # full chunks are not refilled, nChunks*maxFiles covers all files
+        if len(plan[i]) < maxFiles:
+            heapq.heappush(heap, (load + weights[f], i))
+    return [sorted(ch, key = lambda f: order[f]) for ch in plan if len(ch) > 0]
+
 def getEntries(f, treeName = "Events"):
+    return countEntries([f], treeName, nWorkers = 1)[f]
+
+def _treeEntries(f, treeName = "Events"):
+    """Number of entries of treeName in f from the tree header, -1 if the file or tree cannot be read."""
     rf = ROOT.TFile.Open(f, "READ")
-    tree = rf.Get(treeName)
-    entries = int(tree.GetEntries())
-    rf.Close()
+    if rf is None or not rf or rf.IsZombie():
+        return -1
+    try:
+        tree = rf.Get(treeName)
+        if not tree:
+            return -1
+        return int(tree.GetEntries())
+    finally:
+        rf.Close()
+
+def _countEntriesBatch(job):
+    files, treeName = job
+    return [(f, _treeEntries(f, treeName)) for f in files]
+
+def countEntries(files, treeName = "Events", nWorkers = 4, batchSize = 50):
+    """
+    get the number of tree entries of many files from the tree headers
+
+    files are processed in batches of batchSize on a pool of nWorkers processes,
+    a single file is read in-process.
+    returns a dictionary path -> entries, with -1 for unreadable files.
+    """
+    files = list(files)
+    if len(files) == 1:
+        return {files[0]: _treeEntries(files[0], treeName)}
+    jobs = [(batch, treeName) for batch in chunks(files, int(batchSize))]
+    results = _runInProcesses(_countEntriesBatch, jobs, nWorkers)
+
+    entries = {}
+    for batch in results:
+        entries.update(dict(batch))
     return entries
 
 debugFileCheck = False
 def checkFile(f, treeName = None):
+    return _checkFile(f, treeName)[0]
+
+def _checkFile(f, treeName = None):
+    """Check a file like checkFile, return (ok, number of tree entries or -1)."""
     if debugFileCheck: print("checking file {}".format(f))
     if not os.path.exists(f):
-        return False
+        return False, -1
 
     if debugFileCheck: print("1")
     rf = ROOT.TFile.Open(f)
     if rf is None:
-        return False
+        return False, -1
 
     if not rf:
-        return False
+        return False, -1
 
     if rf.TestBit(ROOT.TFile.kZombie):
-        return False
+        return False, -1
 
     if len(rf.GetListOfKeys()) == 0:
-        return False
+        return False, -1
 
     if debugFileCheck: print("2")
     if rf.TestBit(ROOT.TFile.kRecovered):
-        return False
+        return False, -1
 
+    nevts = -1
     if debugFileCheck: print("3")
     if not treeName is None:
         tree = rf.Get(treeName)
         if tree is None:
-            return False
+            return False, -1
 
         if debugFileCheck: print("4")
         if not type(tree) == ROOT.TTree:
-            return False
+            return False, -1
 
         if debugFileCheck: print("5")
-        nevts = tree.GetEntries()
+        nevts = int(tree.GetEntries())
         rf.Close()
 
         if debugFileCheck: print("6")
         if nevts < 0:
-            return False
+            return False, -1
         if nevts == 0:
             printer.printInfo("empty file {}".format(f))
     else:
         rf.Close()
 
-    return True
+    return True, nevts
+
+def _inspectFile(job):
+    """Build the manifest record of a single (path, treeName) job."""
+    f, treeName = job
+    record = {"path": f, "size": -1, "mtime": -1, "entries": -1, "status": "missing"}
+    if not os.path.exists(f):
+        return record
+    st = os.stat(f)
+    record["size"] = st.st_size
+    record["mtime"] = st.st_mtime
+    ok, nevts = _checkFile(f, treeName)
+    record["entries"] = nevts
+    record["status"] = "ok" if ok else "bad"
+    return record
+
+def loadManifest(manifest, treeName = "Events"):
+    """Read the records of a validation manifest, empty if it does not exist or was written for another tree."""
+    if manifest is None or not os.path.exists(manifest):
+        return {}
+    try:
+        with open(manifest, "r") as m:
+            content = json.load(m)
+    except ValueError:
+        printer.printWarning("could not read manifest {} - ignoring it".format(manifest))
+        return {}
+    if not content.get("treeName") == treeName:
+        return {}
+    return content.get("files", {})
+
+def _writeJson(path, content):
+    """Write content as json, replacing path only once it is completely written."""
+    tmp = path+".tmp"
+    with open(tmp, "w") as f:
+        json.dump(content, f, indent = 1, sort_keys = True)
+    os.rename(tmp, path)
+
+def writeManifest(manifest, records, treeName = "Events"):
+    _writeJson(manifest, {"treeName": treeName, "files": records})
+
+def validateFiles(files, treeName = "Events", manifest = None, nWorkers = 4):
+    """
+    check files concurrently with checkFile on a pool of nWorkers processes
+
+    returns a dictionary path -> record with the keys
+    path, size, mtime, entries and status ('ok', 'bad' or 'missing').
+    if a manifest path is given, files whose size and mtime did not change since
+    the manifest was written are not opened again and the updated records are
+    written back to the manifest.
+    """
+    cached = loadManifest(manifest, treeName)
+    records = {}
+    todo = []
+    for f in files:
+        rec = cached.get(f)
+        if not rec is None and os.path.exists(f):
+            st = os.stat(f)
+            if rec["size"] == st.st_size and rec["mtime"] == st.st_mtime:
+                records[f] = rec
+                continue
+        todo.append((f, treeName))
+
+    if len(todo) > 0:
+        printer.printInfo("validating {} of {} files ({} cached)".format(
+            len(todo), len(files), len(files)-len(todo)))
+    checked = _runInProcesses(_inspectFile, todo, nWorkers)
+    for rec in checked:
+        records[rec["path"]] = rec
 
+    if not manifest is None:
+        cached.update(records)
+        writeManifest(manifest, cached, treeName)
+    return records
+
+def _runParallel(func, jobs, nWorkers = 1):
+    """Run func on every job, on a pool of nWorkers threads if nWorkers > 1."""
+    if nWorkers <= 1 or len(jobs) <= 1:
+        return [func(job) for job in jobs]
+    pool = ThreadPool(min(int(nWorkers), len(jobs)))
+    try:
+        return pool.map(func, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+def _runInProcesses(func, jobs, nWorkers = 1):
+    """
+    Like _runParallel but on a process pool, needed for everything opening ROOT files.
+
+    ROOT is not thread safe, so outside of the main thread (e.g. in the sample
+    tasks of MergePlan) the jobs always run in worker processes.
+    """
+    if len(jobs) == 0:
+        return []
+    if hasattr(threading, "main_thread"):
+        inMainThread = threading.current_thread() is threading.main_thread()
+    else:
+        inMainThread = isinstance(threading.current_thread(), threading._MainThread)
+    if inMainThread and (nWorkers <= 1 or len(jobs) <= 1):
+        return [func(job) for job in jobs]
+    pool = Pool(max(1, min(int(nWorkers), len(jobs))))
+    try:
+        return pool.map(func, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+def _removeFiles(files):
+    for f in files:
+        if os.path.exists(f):
+            os.remove(f)
+
+class HaddError(Exception):
+    """Raised by the merge backends if merging into target failed."""
+    def __init__(self, target, reason, inputFile = None, status = None):
+        Exception.__init__(self, target, reason, inputFile, status)
+        self.target = target
+        self.reason = reason
+        self.inputFile = inputFile
+        self.status = status
+
+    def __str__(self):
+        msg = "merging into {} failed: {}".format(self.target, self.reason)
+        if not self.inputFile is None:
+            msg += " (input file {})".format(self.inputFile)
+        if not self.status is None:
+            msg += " (exit status {})".format(self.status)
+        return msg
+
+def _haddShell(outFile, inputs, level):
+    """Merge inputs into outFile with the hadd command."""
+    flags = "-fk -v 0" if level == 0 else "-f -v 0"
+    cmd = "hadd {flags} {outFile} {files}".format(
+        flags = flags, outFile = outFile, files = " ".join(inputs))
+    status = execute(cmd)
+    if not status == 0:
+        # execute returns the wait status of os.system
+        if os.WIFSIGNALED(status):
+            raise HaddError(outFile, "hadd command killed by signal {}".format(os.WTERMSIG(status)))
+        raise HaddError(outFile, "hadd command failed", status = os.WEXITSTATUS(status))
+
+def _haddMerger(outFile, inputs, level):
+    """
+    Merge inputs into outFile in-process with TFileMerger, reporting progress and throughput.
+
+    every input is merged incrementally into the output on its own, such that
+    the progress lines report merged files.
+    """
+    merger = ROOT.TFileMerger(False, False)
+    merger.SetFastMethod(True)
+    merger.SetPrintLevel(0)
+
+    # same as hadd -k: the first level keeps the compression of the first input
+    if level == 0:
+        rf = ROOT.TFile.Open(inputs[0], "READ")
+        if rf is None or not rf or rf.IsZombie():
+            raise HaddError(outFile, "could not open input", inputFile = inputs[0])
+        compression = rf.GetCompressionSettings()
+        rf.Close()
+        opened = merger.OutputFile(outFile, "RECREATE", compression)
+    else:
+        opened = merger.OutputFile(outFile, "RECREATE")
+    if not opened:
+        raise HaddError(outFile, "could not open output file")
+
+    nBytes = 0
+    sTime = time.time()
+    mode = ROOT.TFileMerger.kAll | ROOT.TFileMerger.kIncremental
+    for i, f in enumerate(inputs):
+        if not merger.AddFile(f, False):
+            raise HaddError(outFile, "could not add input", inputFile = f)
+        if not merger.PartialMerge(mode):
+            raise HaddError(outFile, "TFileMerger::PartialMerge failed", inputFile = f)
+        nBytes += os.path.getsize(f)
+        duration = max(time.time() - sTime, 1e-6)
+        printer.printResult("[{:>{w}}/{}] {:8.1f} MB {:6.1f} MB/s | {}".format(
+            i+1, len(inputs), nBytes/1e6, nBytes/1e6/duration, f, w = len(str(len(inputs)))))
+
+    # the output stays open for further incremental merges
+    output = merger.GetOutputFile()
+    if output:
+        output.Close()
+    duration = max(time.time() - sTime, 1e-6)
+    printer.printInfo("merged {} files into {}: {:.1f} MB in {:.1f} s ({:.1f} MB/s)".format(
+        len(inputs), outFile, nBytes/1e6, duration, nBytes/1e6/duration))
+
+haddBackends = {
+    "shell":  _haddShell,
+    "merger": _haddMerger,
+    }
+
+def _haddJob(job):
+    """Run a single (backend, outFile, inputs, level) merge job, return the HaddError if it failed."""
+    backend, outFile, inputs, level = job
+    try:
+        haddBackends[backend](outFile, inputs, level)
+    except HaddError as e:
+        return e
+    return None
+
+def haddTree(files, target, chunkSize = 500, fanIn = None, nWorkers = 4, backend = "shell", plan = None):
+    """
+    merge files into target as a tree of merges
+
+    the inputs are merged in chunks of chunkSize, the resulting chunk files are
+    merged in groups of fanIn on the next level until a single file is left.
+    all merges of one level are run concurrently on nWorkers and the
+    intermediate chunk files are removed once the next level is done.
+
+    plan optionally replaces the chunks of the first level, e.g. from planChunks.
+    backend is one of haddBackends: 'shell' calls the hadd command in threads,
+    'merger' uses TFileMerger in worker processes.
+    raises a HaddError if any of the merges failed.
+    """
+    if not backend in haddBackends:
+        raise ValueError("unknown hadd backend {}, choose from {}".format(
+            backend, sorted(haddBackends.keys())))
+    if fanIn is None:
+        fanIn = chunkSize
+    if int(fanIn) < 2:
+        raise ValueError("fanIn of haddTree needs to be at least 2")
+
+    base = target.replace(".root","")
+    inputs = list(files)
+    groupSize = int(chunkSize)
+    level = 0
+    while True:
+        if level == 0 and not plan is None:
+            groups = plan
+        else:
+            groups = list(chunks(inputs, groupSize))
+        if len(groups) == 1:
+            jobs = [(backend, target, groups[0], level)]
+        else:
+            jobs = [(backend, base+"_chunk_{}_{}.root".format(level, i), ch, level)
+                for i, ch in enumerate(groups)]
+            printer.printInfo("hadd level {}: merging {} files in {} chunks".format(
+                level, len(inputs), len(jobs)))
+
+        # ROOT objects are not thread safe, the in-process backend needs processes
+        if backend == "shell":
+            errors = _runParallel(_haddJob, jobs, nWorkers)
+        else:
+            errors = _runInProcesses(_haddJob, jobs, nWorkers)
+
+        # inputs of higher levels are chunk files of the previous level
+        if level > 0:
+            _removeFiles(inputs)
+
+        errors = [e for e in errors if not e is None]
+        if len(errors) > 0:
+            for e in errors:
+                printer.printError(str(e))
+            if len(jobs) > 1:
+                _removeFiles([job[1] for job in jobs])
+            raise errors[0]
+
+        if len(jobs) == 1:
+            return True
+        inputs = [job[1] for job in jobs]
+        groupSize = int(fanIn)
+        level += 1
+
+def _branchSummary(job):
+    """
+    Per-branch entries and sums of branches over a batch of (files, treeName, branches), None if a file is not readable.
+    branches missing in a file of the batch are listed in "missing" and not summed.
+    """
+    files, treeName, branches = job
+    entries = {}
+    missing = set()
+    for f in files:
+        rf = ROOT.TFile.Open(f, "READ")
+        if rf is None or not rf or rf.IsZombie():
+            return None
+        tree = rf.Get(treeName)
+        if not tree:
+            rf.Close()
+            return None
+        for br in tree.GetListOfBranches():
+            entries[br.GetName()] = entries.get(br.GetName(), 0) + int(br.GetEntries())
+        missing.update(b for b in branches if not tree.GetBranch(b))
+        rf.Close()
+
+    sums = {}
+    summed = [b for b in branches if not b in missing]
+    if summed:
+        # sums are additive over files, a single event loop per batch is enough
+        chain = ROOT.TChain(treeName)
+        for f in files:
+            chain.Add(f)
+        try:
+            df = ROOT.RDataFrame(chain)
+            results = dict((b, df.Sum(b)) for b in summed)
+            sums = dict((b, float(r.GetValue())) for b, r in results.items())
+        except Exception as e:
+            return {"entries": entries, "sums": {}, "missing": sorted(missing), "error": str(e)}
+    return {"entries": entries, "sums": sums, "missing": sorted(missing)}
+
+def verifyMerge(files, target, treeName = "Events", branches = None, nWorkers = 4, batchSize = 50, rtol = 1e-6):
+    """
+    compare the merged target with its inputs beyond the total number of entries
+
+    checks that target has the same branches as the inputs with the summed number
+    of entries per branch. for the given branches the sum over all values is
+    compared as a checksum, within a relative tolerance rtol as the summation
+    order differs. the inputs are read in batches on nWorkers processes.
+    """
+    branches = list(branches or [])
+    jobs = [(batch, treeName, branches) for batch in chunks(list(files), int(batchSize))]
+    jobs.append(([target], treeName, branches))
+    summaries = _runInProcesses(_branchSummary, jobs, nWorkers)
+    if any(summary is None for summary in summaries):
+        printer.printError("could not read {} of all inputs or the target of {}".format(treeName, target))
+        return False
 
-def hadd(files, target, entries = -1, treeName = "Events", inChunks=True, chunkSize=500):
+    ok = True
+    for (batch, _, _), summary in zip(jobs, summaries):
+        if summary["missing"]:
+            printer.printError("branches {} not found in {} of {} ({} files)".format(
+                ", ".join(summary["missing"]), treeName, batch[0], len(batch)))
+            ok = False
+        if "error" in summary:
+            printer.printError("could not sum branches of {}: {}".format(batch[0], summary["error"]))
+            ok = False
+    if not ok:
+        return False
+
+    merged = summaries.pop()
+    entries = {}
+    sums = dict((b, 0.) for b in branches)
+    for summary in summaries:
+        for b, n in summary["entries"].items():
+            entries[b] = entries.get(b, 0) + n
+        for b, v in summary["sums"].items():
+            sums[b] += v
+
+    ok = True
+    for b in sorted(set(entries.keys()) | set(merged["entries"].keys())):
+        source = entries.get(b)
+        result = merged["entries"].get(b)
+        if not source == result:
+            printer.printError("branch {}: entries in inputs {} | target {}".format(b, source, result))
+            ok = False
+    for b in branches:
+        if abs(sums[b] - merged["sums"][b]) > rtol*max(abs(sums[b]), abs(merged["sums"][b]), 1.):
+            printer.printError("branch {}: sum of inputs {} | target {}".format(b, sums[b], merged["sums"][b]))
+            ok = False
+
+    if ok:
+        printer.printInfo("verified {} branches ({} checksums) of {}".format(
+            len(entries), len(branches), target))
+    return ok
+
+def hadd(files, target, entries = -1, treeName = "Events", inChunks=True, chunkSize=500, fanIn=None, nWorkers=4, manifest=None, backend="shell",
+        balance=None, maxBytes=None, maxMemory=None, maxOpenFiles=None, checkInputs=True,
+        verify=False, verifyBranches=None):
     # check availability of all files
     ok = True
-    if not treeName is None:
+    records = None
+    if checkInputs and not treeName is None:
+        records = validateFiles(files, treeName, manifest = manifest, nWorkers = nWorkers)
         for f in files:
-            if not checkFile(f, treeName):
+            if not records[f]["status"] == "ok":
                 ok = False
                 printer.printError("hadd input file {} is not ok".format(f))
         if not ok:
@@ -86,23 +540,46 @@ def hadd(files, target, entries = -1, treeName = "Events", inChunks=True, chunkS
         cmd = ["cp"]+files+[target]
         execute(" ".join(cmd))
         return True
-    elif not inChunks or len(files) <= chunkSize:
-        cmd = ["hadd"]+["-fk"]+[target]+files
-        execute(" ".join(cmd))
+
+    if not inChunks:
+        chunkSize = len(files)
+
+    if not maxBytes is None and not balance == "bytes":
+        printer.printError("maxBytes of hadd needs balance = 'bytes'")
+        return False
+
+    # no merge may open more files than allowed, on any level of the tree
+    if maxOpenFiles is None:
+        maxOpenFiles = openFileLimit()
+    if not maxOpenFiles is None:
+        fanIn = min(int(fanIn or chunkSize), max(int(maxOpenFiles), 2))
+
+    # balance the chunks by 'bytes' or 'entries' instead of the number of files
+    plan = None
+    if not balance is None:
+        if balance == "bytes":
+            weights = dict((f, os.path.getsize(f)) for f in files)
+        elif balance == "entries" and not records is None:
+            weights = dict((f, records[f]["entries"]) for f in files)
+        else:
+            printer.printError("cannot balance hadd chunks by {} (treeName {})".format(balance, treeName))
+            return False
+        plan = planChunks(files, chunkSize, weights, maxWeight = maxBytes,
+            maxOpenFiles = maxOpenFiles, maxMemory = maxMemory)
     else:
-        # hadd in chunks
-        hadd_parts = []
-        for i, ch in enumerate(chunks(files, chunkSize)):
-            outFile = target.replace(".root","")+"_chunk_{}.root".format(i)
-            hadd_parts.append(outFile)
-            cmd = "hadd -v 0 -fk {outFile} {files} ".format(files=" ".join(ch), outFile=outFile)
-            execute(cmd)
-        # hadd all chunks together
-        cmd = "hadd -f -v 0 {outFile} {files}".format(files =" ".join(hadd_parts), outFile = target)
-        execute(cmd)
-        # remove hadd parts
-        cmd = "rm {files}".format(files = " ".join(hadd_parts))
-        execute(cmd)
+        # consecutive chunks, within the same limits planChunks applies (10 MB per open file)
+        if not maxOpenFiles is None:
+            chunkSize = min(int(chunkSize), int(maxOpenFiles))
+        if not maxMemory is None:
+            chunkSize = min(int(chunkSize), int(float(maxMemory)/10.))
+        chunkSize = max(int(chunkSize), 1)
+
+    try:
+        haddTree(files, target, chunkSize = chunkSize, fanIn = fanIn,
+            nWorkers = nWorkers, backend = backend, plan = plan)
+    except HaddError:
+        printer.printError("hadd into {} failed".format(target))
+        return False
 
     if entries >= 0:
         haddedEntries = getEntries(target, treeName)
@@ -111,40 +588,299 @@ def hadd(files, target, entries = -1, treeName = "Events", inChunks=True, chunkS
             printer.printError("source: {} | target: {}".format(entries, haddedEntries))
             return False
 
+    # compare per-branch entries and checksums of verifyBranches
+    if verify and not treeName is None:
+        if not verifyMerge(files, target, treeName, verifyBranches, nWorkers = nWorkers):
+            printer.printError("verification of {} failed".format(target))
+            return False
+
     return True
 
-cutflowRegex = r"([0-9]+): (.*?) : ([0-9]+)"
-def mergeCutflow(files, target):
-    stages = []
-    values = {}
-    first = True
+haddScriptTemplate = """#!/bin/bash
+{setup}
+hadd -fk -v 0 {outFile} \\
+{files}
+"""
+
+def writeHaddScripts(plan, target, scriptDir):
+    """
+    write one shell script per chunk of plan that merges the chunk with hadd
+
+    the CMSSW environment of the submitting shell is set up in the scripts.
+    returns the list of scripts and the list of chunk files they produce.
+    """
+    mkdir(scriptDir)
+    setup = ""
+    if "CMSSW_BASE" in os.environ:
+        setup = cmsswSetupTemplate.format(cmssw = os.environ["CMSSW_BASE"])
+
+    base = os.path.abspath(target).replace(".root","")
+    scripts = []
+    outFiles = []
+    for i, ch in enumerate(plan):
+        outFile = base+"_batchchunk_{}.root".format(i)
+        script = os.path.join(scriptDir, os.path.basename(base)+"_hadd_{}.sh".format(i))
+        with open(script, "w") as sh:
+            sh.write(haddScriptTemplate.format(setup = setup, outFile = outFile,
+                files = " \\\n".join(os.path.abspath(f) for f in ch)))
+        st = os.stat(script)
+        os.chmod(script, st.st_mode | stat.S_IEXEC)
+        scripts.append(script)
+        outFiles.append(outFile)
+    return scripts, outFiles
+
+def haddOnBatch(files, target, workdir, entries = -1, treeName = "Events", chunkSize = 500,
+        balance = "bytes", queryInterval = 60, memory_ = "2000", disk_ = "1000000", runtime_ = "10800",
+        nWorkers = 4, manifest = None, **kwargs):
+    """
+    merge the chunks of hadd as condor jobs and only do the final merge locally
+
+    the chunk plan (see planChunks, balance 'bytes' or None) is turned into one
+    shell script per chunk in workdir, submitted with condorSubmit.submitToBatch
+    and waited for with condorSubmit.monitorJobStatus following the job logs. afterwards the chunk
+    files are checked and merged into target with hadd and removed.
+    further keyword arguments are passed to the final hadd.
+    """
+    if len(files) == 0:
+        printer.printError("no files passed to hadd")
+        return False
+    if not treeName is None:
+        records = validateFiles(files, treeName, manifest = manifest, nWorkers = nWorkers)
+        bad = [f for f in files if not records[f]["status"] == "ok"]
+        for f in bad:
+            printer.printError("hadd input file {} is not ok".format(f))
+        if len(bad) > 0:
+            return False
+
+    if balance == "bytes":
+        plan = planChunks(files, chunkSize, maxOpenFiles = openFileLimit())
+    else:
+        plan = list(chunks(list(files), int(chunkSize)))
+    if len(plan) == 1:
+        printer.printInfo("only one chunk to merge - merging locally")
+        return hadd(files, target, entries = entries, treeName = treeName,
+            nWorkers = nWorkers, checkInputs = False, **kwargs)
+
+    workdir = mkdir(workdir)
+    name = os.path.basename(target).replace(".root","")
+    scripts, outFiles = writeHaddScripts(plan, target, os.path.join(workdir, "scripts"))
+    printer.printInfo("submitting {} hadd chunks of {} to the batch system".format(len(scripts), target))
+    jobIDs = submitToBatch(workdir, scripts,
+        memory_ = memory_, disk_ = disk_, runtime_ = runtime_, name_ = name+"_hadd")
+    monitorJobStatus(jobIDs, queryInterval = queryInterval, nTotalJobs = len(scripts), workdir = workdir)
+
+    # chunk files are validated as inputs of the final merge
+    ok = hadd(outFiles, target, entries = entries, treeName = treeName,
+        nWorkers = nWorkers, **kwargs)
+    if ok:
+        _removeFiles(outFiles)
+    else:
+        printer.printError("final merge of batch chunks failed, chunk files are kept:")
+        for f in outFiles:
+            printer.printPath("\t"+f)
+    return ok
+
+def journalPath(target):
+    return target+".journal.json"
+
+def loadJournal(target):
+    """Read the merge journal of target, None if there is none."""
+    path = journalPath(target)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as j:
+        return json.load(j)
+
+def haddIncremental(files, target, treeName = "Events", **kwargs):
+    """
+    merge only those files into target that were not merged before
+
+    the inputs already merged into target are listed in a journal next to it
+    (see journalPath) together with the total number of entries.
+    new files are appended to the existing target in place (hadd -a), so the
+    content merged before is not read or written again. afterwards the entries
+    of the target have to match the journal plus the new inputs, otherwise the
+    journal is left as it was and the next call asks for a full merge.
+    without journal or target, all files are merged and a journal is started.
+    inputs that changed since they were merged require a full merge with hadd.
+    further keyword arguments are passed to hadd.
+    """
+    if treeName is None:
+        printer.printError("haddIncremental needs a treeName to keep track of entries")
+        return False
+
+    journal = loadJournal(target)
+    if journal is None or not os.path.exists(target):
+        if os.path.exists(target):
+            printer.printWarning("no merge journal for {} - merging all files".format(target))
+        journal = {"treeName": treeName, "entries": 0, "inputs": {}}
+        existing = []
+    else:
+        if not journal["treeName"] == treeName:
+            printer.printError("journal of {} was written for tree {}".format(target, journal["treeName"]))
+            return False
+        existing = [target]
+        # the target has to be in the state the journal describes
+        targetEntries = getEntries(target, treeName)
+        if not targetEntries == journal["entries"]:
+            printer.printError("entries of {} do not match its journal".format(target))
+            printer.printError("journal: {} | target: {}".format(journal["entries"], targetEntries))
+            return False
+
+    newFiles = []
+    changed = False
     for f in files:
-        with open(f, "r") as c:
-            lines = c.readlines()
+        if not f in journal["inputs"]:
+            newFiles.append(f)
+            continue
+        rec = journal["inputs"][f]
+        if os.path.exists(f):
+            st = os.stat(f)
+            if not (rec["size"] == st.st_size and rec["mtime"] == st.st_mtime):
+                printer.printError("input {} changed since it was merged".format(f))
+                changed = True
+    if changed:
+        printer.printError("changed inputs cannot be merged incrementally - use hadd for a full merge")
+        return False
+    if len(newFiles) == 0:
+        printer.printInfo("no new files to merge into {}".format(target))
+        return True
+    printer.printInfo("merging {} new files into {} ({} merged before)".format(
+        len(newFiles), target, len(journal["inputs"])))
+
+    records = validateFiles(newFiles, treeName,
+        manifest = kwargs.pop("manifest", None), nWorkers = kwargs.get("nWorkers", 4))
+    for f in newFiles:
+        if not records[f]["status"] == "ok":
+            printer.printError("hadd input file {} is not ok".format(f))
+            return False
+    entries = journal["entries"] + sum(records[f]["entries"] for f in newFiles)
+
+    if len(existing) == 0:
+        # inputs were validated above
+        kwargs["checkInputs"] = False
+        if not hadd(newFiles, target, entries = entries, treeName = treeName, **kwargs):
+            return False
+    else:
+        # append in chunks to stay below the limit of open files
+        for ch in chunks(newFiles, int(kwargs.get("chunkSize", 500))):
+            status = execute("hadd -a -v 0 {} {}".format(target, " ".join(ch)))
+            if not status == 0:
+                printer.printError("appending to {} failed".format(target))
+                break
+        targetEntries = getEntries(target, treeName)
+        if not targetEntries == entries:
+            printer.printError("entries of {} after appending do not match: expected {} | target {}".format(
+                target, entries, targetEntries))
+            printer.printError("the target does not match its journal anymore - use hadd for a full merge")
+            return False
 
-        for l in lines:
-            match = re.search(cutflowRegex, l)
+    for f in newFiles:
+        journal["inputs"][f] = dict((k, records[f][k]) for k in ["size", "mtime", "entries"])
+    journal["entries"] = entries
+    _writeJson(journalPath(target), journal)
+    printer.printInfo("merge journal of {} updated: {} inputs, {} entries".format(
+        target, len(journal["inputs"]), entries))
+    return True
+
+cutflowRegex = re.compile(r"([0-9]+): (.*?) : ([0-9]+)")
+def parseCutflow(f):
+    """
+    read a cutflow file line by line
+
+    returns an ordered dictionary stage -> count and a list of
+    (line number, line) of all lines that could not be parsed.
+    """
+    values = OrderedDict()
+    errors = []
+    with open(f, "r") as c:
+        for i, l in enumerate(c):
+            if l.strip() == "":
+                continue
+            match = cutflowRegex.search(l)
             if match is None:
-                printer.printError("cutflow file not parseable")
-                return False        
-    
-            if first:
-                stages.append(match.group(2))
-                values[match.group(2)] = 0
-
-            if not match.group(2) in stages:
-                #printer.printError("cutflow step {} not in first file".format(match.group(2)))
-                stages.append(match.group(2))
-                values[match.group(2)] = 0
-            
-            values[match.group(2)] += int(match.group(3))
-
-        if first: first = False    
-
-    with open(target, "w") as t:
-        for i, s in enumerate(stages):
-            t.write("{}: {} : {}\n".format(
-                i, s, values[s]))
-    
+                errors.append((i+1, l.rstrip("\n")))
+                continue
+            stage = match.group(2)
+            values[stage] = values.get(stage, 0) + int(match.group(3))
+    return values, errors
+
+def _parseCutflowJob(f):
+    return f, parseCutflow(f)
+
+class CutflowResult:
+    """
+    merged cutflow of several files
+
+    stages:     ordered dictionary stage -> summed count, in order of first appearance
+    provenance: dictionary file -> ordered dictionary stage -> count of that file
+    errors:     dictionary file -> list of (line number, line) that could not be parsed
+    """
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.provenance = OrderedDict()
+        self.errors = OrderedDict()
+
+    def add(self, f, values, errors = []):
+        self.provenance[f] = values
+        if len(errors) > 0:
+            self.errors[f] = errors
+        for stage, n in values.items():
+            self.stages[stage] = self.stages.get(stage, 0) + n
+
+    def ok(self):
+        return len(self.errors) == 0
+
+    def write(self, target):
+        """Write the merged cutflow in the text format of the inputs."""
+        with open(target, "w") as t:
+            for i, s in enumerate(self.stages):
+                t.write("{}: {} : {}\n".format(i, s, self.stages[s]))
+
+    def writeJson(self, target):
+        content = {
+            "stages": [{"index": i, "stage": s, "count": n}
+                for i, (s, n) in enumerate(self.stages.items())],
+            "files": self.provenance,
+            }
+        with open(target, "w") as t:
+            json.dump(content, t, indent = 1)
+
+    def writeCsv(self, target):
+        with open(target, "w") as t:
+            writer = csv.writer(t)
+            writer.writerow(["index", "stage", "count"])
+            for i, (s, n) in enumerate(self.stages.items()):
+                writer.writerow([i, s, n])
+
+def mergeCutflows(files, nWorkers = 4):
+    """Parse cutflow files concurrently on nWorkers threads and merge them into a CutflowResult."""
+    result = CutflowResult()
+    for f, (values, errors) in _runParallel(_parseCutflowJob, list(files), nWorkers):
+        result.add(f, values, errors)
+    return result
+
+def mergeCutflow(files, target, nWorkers = 4, formats = []):
+    """
+    merge cutflow files into target
+
+    formats can contain 'json' and 'csv' to write the result next to
+    the text file as well. returns False if a file was not parseable.
+    """
+    result = mergeCutflows(files, nWorkers)
+    if not result.ok():
+        for f, errors in result.errors.items():
+            printer.printError("cutflow file {} not parseable".format(f))
+            for i, l in errors:
+                printer.printError("\tline {}: {}".format(i, l))
+        return False
+
+    result.write(target)
+    base = os.path.splitext(target)[0]
+    if "json" in formats:
+        result.writeJson(base+".json")
+    if "csv" in formats:
+        result.writeCsv(base+".csv")
+
     printer.printInfo("merged cutflow at {}".format(target))
     return True